@@ -17,6 +17,7 @@ if version_error:
 
 if PY3:
   unicode = str
+  unichr = chr
   string_types = (unicode, bytes)
   integer_types = (int,)
 
@@ -62,6 +63,7 @@ if PY3:
 
 else:
   bytes = str
+  unichr = unichr
   string_types = basestring
   integer_types = (int, long)
 
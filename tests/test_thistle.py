@@ -96,6 +96,8 @@ class BaseTestCase(unittest.TestCase):
     remove_file_without_exc(TEST_DIR + "/thistle.log")
     remove_file_without_exc(TEST_DIR + "/thistle.pid")
     remove_file_without_exc(thistle.DBThread.db_file)
+    remove_file_without_exc(thistle.DBThread.db_file + "-wal")
+    remove_file_without_exc(thistle.DBThread.db_file + "-shm")
     remove_file_without_exc(TEST_DIR + "/monitor.log")
 
 # Event {{{
@@ -122,6 +124,37 @@ class TestEvent(unittest.TestCase):
     self.assertTrue("LEVEL2" == Event.as_string(Event.LEVEL2))
 # }}}
 
+# PatternSet {{{
+class TestPatternSet(unittest.TestCase):
+  def test_required_literal(self):
+    self.assertTrue(PatternSet.required_literal(re.compile(".*error.*")) == "error")
+    self.assertTrue(PatternSet.required_literal(re.compile("^ab(cde)f+g")) == "abcde")
+    self.assertTrue(PatternSet.required_literal(re.compile("(?i)error")) is None)
+    self.assertTrue(PatternSet.required_literal(re.compile("foo|barbaz")) is None)
+
+  def test_matches(self):
+    patterns = ["err", "error", ".*error.*", "rror", "foo.*bar", "(?i)warn", "x+", "^sleep \\d+$", "ab|cd"]
+    lines = ["error", "an error occurred", "WARN: foo bar", "foobar err", "sleep 10", "sleep", "xx cd", ""]
+    for method in ("search", "match"):
+      pattern_set = PatternSet(patterns, method)
+      for line in lines:
+        expected = [i for i, v in enumerate(patterns) if getattr(re.compile(v), method)(line)]
+        self.assertTrue([v[0] for v in pattern_set.matches(line)] == expected)
+      self.assertTrue(pattern_set.counts(lines) == 
+        [len([l for l in lines if getattr(re.compile(v), method)(l)]) for v in patterns])
+
+  def test_combine(self):
+    self.assertTrue(PatternSet.combine([re.compile("x+"), re.compile("a|b")]).pattern == "(?:x+)|(?:a|b)")
+    self.assertTrue(PatternSet.combine([re.compile("x+"), re.compile("(?i)a")]) is None)
+    self.assertTrue(PatternSet.combine([re.compile("x+"), re.compile("(a)\\1")]) is None)
+    patterns = ["x+", "a|b", "\\d{3}", ".*error.*"]
+    pattern_set = PatternSet(patterns, "match")
+    self.assertTrue(pattern_set.any_always is not None)
+    for line in ["xx", "b", "123", "an error", "zzz", ""]:
+      expected = [i for i, v in enumerate(patterns) if re.match(v, line)]
+      self.assertTrue([v[0] for v in pattern_set.matches(line)] == expected)
+# }}}
+
 # ProcessMonitor {{{
 class DummyProcessMonitorSleep2(ProcessMonitor):
   def get_process_list(self): return ["sleep", "sleep"]
@@ -258,6 +291,105 @@ class TestProcessMonitor(BaseTestCase):
     expected_log = "INFO: [DummyProcessMonitorSleepIncrement] sleep process: Resume normal operations."
     self.assertTrue(len(line_contains(log_content, expected_log)) == 1)
 
+  def test_proc_process_list(self):
+    processes = dict((v.pid, v) for v in ProcessInfo.read_all())
+    process = processes[os.getpid()]
+    self.assertTrue(process.ppid == os.getppid())
+    self.assertTrue("test_thistle" in process.cmdline)
+    line = process.as_ps_line().split()
+    self.assertTrue(line[1:3] == [str(os.getpid()), str(os.getppid())])
+    self.assertTrue("test_thistle" in " ".join(line[7:]))
+
+  def test_process_table_snapshot(self):
+    table = ProcessTable()
+    processes = table.snapshot("proc", 60)
+    self.assertTrue(table.snapshot("proc", 60) is processes)
+    self.assertTrue(table.stats() == {"hits": 1, "misses": 1})
+    self.assertTrue(table.snapshot("proc", 0) is not processes)
+    self.assertTrue(table.stats() == {"hits": 1, "misses": 2})
+    process = [v for v in table.snapshot("proc", 0) if v.pid == os.getpid()][0]
+    self.assertTrue(process.cpu_percent is not None)
+    self.assertTrue(process.rss > 0 and process.threads > 0 and process.open_fds() > 0)
+
+  @unittest.skipIf(thistle.asyncio is None, "requires asyncio")
+  def test_process_table_async_snapshot(self):
+    table = ProcessTable()
+    loop = thistle.asyncio.new_event_loop()
+    try:
+      # concurrent misses share one ps run.
+      futures = [table.async_snapshot("ps", 60, loop) for i in irange(3)]
+      self.assertTrue(futures[1] is futures[0] and futures[2] is futures[0])
+      processes = loop.run_until_complete(futures[0])
+      self.assertTrue(loop.run_until_complete(table.async_snapshot("ps", 60, loop)) is processes)
+    finally:
+      loop.close()
+    self.assertTrue(table.stats() == {"hits": 3, "misses": 1})
+    self.assertTrue(table.pending == {})
+
+  def test_resource_thresholds(self):
+    config = BASE_CONFIG.copy()
+    config.update({
+      "monitors": [
+        (ProcessMonitor, {
+          "interval": 3,
+          "targets": [
+            {"name": "test process",
+             "pattern": "^\\S+ +{} ".format(os.getpid()),
+             "max_rss": 1},
+            {"name": "test process",
+             "pattern": "^\\S+ +{} ".format(os.getpid()),
+             "max_threads": 1000,
+             "max_fds": 0,
+             "level": Event.WARN}
+          ]
+        }),
+      ]
+    })
+    thistle.KERNEL = thistle.Kernel(config)
+    thistle.KERNEL.start(loop=False)
+    time.sleep(1)
+    thistle.KERNEL.shutdown()
+    log_content = read_logcontent()
+    expected_log = "ERROR: [ProcessMonitor] test process: RSS"
+    self.assertTrue(len(line_contains(log_content, expected_log)) == 1)
+    expected_log = "WARN: [ProcessMonitor] test process: "
+    self.assertTrue(len(line_contains(log_content, expected_log)) == 1)
+    self.assertTrue(len(line_contains(log_content, "open files(> 0)")) == 1)
+
+  def test_critical(self):
+    import subprocess
+    process = subprocess.Popen(["sleep", "59.5"], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    config = BASE_CONFIG.copy()
+    config.update({
+      "monitors": [
+        (ProcessMonitor, {
+          "interval": 60,
+          "targets": [
+            {"name": "sleep process",
+             "pattern": "sleep 59\\.5",
+             "min": 1,
+             "critical": True}
+          ]
+        }),
+      ]
+    })
+    thistle.KERNEL = thistle.Kernel(config)
+    thistle.KERNEL.start(loop=False)
+    time.sleep(1)
+    process.kill()
+    process.wait()
+    time.sleep(2)
+    thistle.KERNEL.shutdown()
+    log_content = read_logcontent()
+    expected_log = "ERROR: [ProcessMonitor] sleep process: 0 process(< 1)"
+    self.assertTrue(len(line_contains(log_content, expected_log)) == 1)
+
+    # processes listed by ps are not watched.
+    ProcessMonitor({"interval": 60, "source": "ps",
+                    "targets": [{"name": "ps process", "pattern": "sleep", "critical": True}]})
+    expected_log = "WARN: ps process: critical targets are not watched with the ps source."
+    self.assertTrue(len(line_contains(read_logcontent(), expected_log)) == 1)
+
 # }}}
 
 # CommandOutputVarMonitor {{{
@@ -393,6 +525,266 @@ class TestCommandOuputVarMonitor(BaseTestCase):
     expected_log = "INFO: [DummyCommandOutputVarMonitor100to90] MEM_USAGE: Resume normal operations."
     self.assertTrue(len(line_contains(log_content, expected_log)) == 1)
 
+  def test_persistent(self):
+    config = BASE_CONFIG.copy()
+    config.update({
+      "monitors": [
+        (CommandOutputVarMonitor, {
+          "interval": 1,
+          "command": "echo CPU_USAGE=100; echo; sleep 1.2; echo CPU_USAGE=50; echo; sleep 60",
+          "persistent": True,
+          "restart_delay": 0.1,
+          "targets": [
+            {"name": "CPU_USAGE",
+             "gt": 90}
+          ]
+        }),
+        (CommandOutputVarMonitor, {
+          "interval": 1,
+          "command": "echo MEM_USAGE=100; echo",
+          "persistent": True,
+          "restart_delay": 0.1,
+          "targets": [
+            {"name": "MEM_USAGE",
+             "gt": 90}
+          ]
+        }),
+      ]
+    })
+    thistle.KERNEL = thistle.Kernel(config)
+    thistle.KERNEL.start(loop=False)
+    time.sleep(3)
+    self.assertTrue(thistle.KERNEL.monitors[1].coprocess.restarts > 0)
+    # a block that has been checked is not waited for.
+    started_at = time.time()
+    self.assertTrue(thistle.KERNEL.monitors[0].read_block() is None)
+    self.assertTrue(time.time() - started_at < 0.1)
+    thistle.KERNEL.shutdown()
+    log_content = read_logcontent()
+    expected_log = "ERROR: [CommandOutputVarMonitor] CPU_USAGE: 100 (> 90)"
+    self.assertTrue(len(line_contains(log_content, expected_log)) == 1)
+    expected_log = "INFO: [CommandOutputVarMonitor] CPU_USAGE: Resume normal operations."
+    self.assertTrue(len(line_contains(log_content, expected_log)) == 1)
+    expected_log = "ERROR: [CommandOutputVarMonitor] MEM_USAGE: 100 (> 90)"
+    self.assertTrue(len(line_contains(log_content, expected_log)) == 1)
+
+  def test_persistent_limit(self):
+    config = BASE_CONFIG.copy()
+    config.update({
+      "monitors": [
+        (CommandOutputVarMonitor, {
+          "interval": 1,
+          "command": "for i in $(seq 20); do echo CPU_USAGE=100; done; echo; "
+                     "printf 'CPU_USAGE=100%.0s' $(seq 100); echo; echo; "
+                     "echo MEM_USAGE=100; echo; sleep 60",
+          "persistent": True,
+          "max_block_lines": 10,
+          "max_output": 1000,
+          "targets": [
+            {"name": "CPU_USAGE",
+             "gt": 90},
+            {"name": "MEM_USAGE",
+             "gt": 90}
+          ]
+        }),
+      ]
+    })
+    thistle.KERNEL = thistle.Kernel(config)
+    thistle.KERNEL.start(loop=False)
+    time.sleep(1.5)
+    thistle.KERNEL.shutdown()
+    log_content = read_logcontent()
+    self.assertTrue(len(line_contains(log_content, "dropped it.")) == 2)
+    self.assertTrue(len(line_contains(log_content, "CPU_USAGE: 100 (> 90)")) == 0)
+    self.assertTrue(len(line_contains(log_content, "MEM_USAGE: 100 (> 90)")) == 1)
+
+  def test_sysinfo(self):
+    sysinfo = SysInfo()
+    values = sysinfo()
+    for name in ["CPU_USAGE", "LOAD_AVERAGE_1", "LOAD_AVERAGE_5", "LOAD_AVERAGE_15", 
+                 "MEM_USAGE", "SWAP_USAGE", "DISK_USAGE_/"]:
+      self.assertTrue(name in values)
+    self.assertTrue(not [v for v in values if v.startswith("DEV_")])
+    values = sysinfo()
+    devices = [v[len("DEV_UTIL_"):] for v in values if v.startswith("DEV_UTIL_")]
+    for device in devices:
+      self.assertTrue("DEV_RKBS_"+device in values and "DEV_WKBS_"+device in values)
+
+    config = BASE_CONFIG.copy()
+    config.update({
+      "monitors": [
+        (CommandOutputVarMonitor, {
+          "interval": 3,
+          "command": sysinfo,
+          "targets": [
+            {"name": "MEM_USAGE",
+             "lt": 101}
+          ]
+        }),
+      ]
+    })
+    thistle.KERNEL = thistle.Kernel(config)
+    thistle.KERNEL.start(loop=False)
+    time.sleep(1)
+    thistle.KERNEL.shutdown()
+    log_content = read_logcontent()
+    expected_log = "ERROR: [CommandOutputVarMonitor] MEM_USAGE: "
+    self.assertTrue(len(line_contains(log_content, expected_log)) == 1)
+
+  def test_timeout(self):
+    config = BASE_CONFIG.copy()
+    config.update({
+      "monitors": [
+        (CommandOutputVarMonitor, {
+          "interval": 60,
+          "command": "sleep 30; echo CPU_USAGE=100",
+          "timeout": 0.5,
+          "targets": [
+            {"name": "CPU_USAGE",
+             "gt": 90}
+          ]
+        }),
+      ]
+    })
+    thistle.KERNEL = thistle.Kernel(config)
+    thistle.KERNEL.start(loop=False)
+    time.sleep(1.5)
+    thistle.KERNEL.shutdown()
+    log_content = read_logcontent()
+    self.assertTrue(len(line_contains(log_content, "timed out after 0.5 secs")) == 1)
+
+  def test_window(self):
+    samples = [100, 10, 10, 10, 100, 100]
+    def command():
+      return {"CPU_USAGE": samples.pop(0) if len(samples) > 1 else samples[0]}
+    config = BASE_CONFIG.copy()
+    config.update({
+      "monitors": [
+        (CommandOutputVarMonitor, {
+          "interval": 0.1,
+          "command": command,
+          "targets": [
+            {"name": "CPU_USAGE",
+             "window": 3,
+             "avg_gt": 50}
+          ]
+        }),
+      ]
+    })
+    thistle.KERNEL = thistle.Kernel(config)
+    thistle.KERNEL.start(loop=False)
+    time.sleep(1.5)
+    thistle.KERNEL.shutdown()
+    log_content = read_logcontent()
+    self.assertTrue(len(line_contains(log_content, "ERROR: [CommandOutputVarMonitor] CPU_USAGE: average")) == 1)
+    expected_log = "ERROR: [CommandOutputVarMonitor] CPU_USAGE: average 70.00 of 3 samples (> 50)."
+    self.assertTrue(len(line_contains(log_content, expected_log)) == 1)
+
+  def test_glob_targets(self):
+    config = BASE_CONFIG.copy()
+    config.update({
+      "monitors": [
+        (CommandOutputVarMonitor, {
+          "interval": 60,
+          "command": "echo DISK_USAGE_/=95; echo DISK_USAGE_/boot=10; echo DISK_USAGE_/var=99.5; echo MEM_USAGE=50",
+          "targets": [
+            {"name": "DISK_USAGE_*",
+             "gt": 90},
+            {"name": "MEM_USAGE",
+             "gt": 40}
+          ]
+        }),
+      ]
+    })
+    thistle.KERNEL = thistle.Kernel(config)
+    thistle.KERNEL.start(loop=False)
+    time.sleep(1)
+    values = thistle.KERNEL.monitors[0].parse_values("A=1\nB=-2.5\nC=+3abc\nD=x\n")
+    thistle.KERNEL.shutdown()
+    self.assertTrue(values == {"A": 1, "B": -2.5, "C": 3})
+    self.assertTrue(isinstance(values["A"], int))
+    log_content = read_logcontent()
+    self.assertTrue(len(line_contains(log_content, "ERROR: [CommandOutputVarMonitor] DISK_USAGE_/: 95 (> 90).")) == 1)
+    self.assertTrue(len(line_contains(log_content, "ERROR: [CommandOutputVarMonitor] DISK_USAGE_/var: 99.5 (> 90).")) == 1)
+    self.assertTrue(len(line_contains(log_content, "ERROR: [CommandOutputVarMonitor] DISK_USAGE_/boot")) == 0)
+    self.assertTrue(len(line_contains(log_content, "ERROR: [CommandOutputVarMonitor] MEM_USAGE: 50 (> 40).")) == 1)
+
+  def test_glob_expire(self):
+    config = BASE_CONFIG.copy()
+    config.update({
+      "monitors": [
+        (CommandOutputVarMonitor, {
+          "interval": 60,
+          "command": "echo DISK_USAGE_/=95; echo DISK_USAGE_/var=99.5",
+          "targets": [
+            {"name": "DISK_USAGE_*",
+             "avg_gt": 90,
+             "window": 5}
+          ]
+        }),
+      ]
+    })
+    thistle.KERNEL = thistle.Kernel(config)
+    thistle.KERNEL.start(loop=False)
+    time.sleep(0.5)
+    monitor = thistle.KERNEL.monitors[0]
+    expanded = sorted(name for name, targets in iter_items(monitor.expanded) if targets)
+    window_memory = monitor.window_memory
+    monitor.expire({"DISK_USAGE_/": 95}, time.time() + 3600)
+    thistle.KERNEL.shutdown()
+    self.assertTrue(expanded == ["DISK_USAGE_/", "DISK_USAGE_/var"])
+    self.assertTrue(window_memory == 2 * thistle.RingBuffer.memory(5))
+    self.assertTrue(list(monitor.expanded) == ["DISK_USAGE_/"])
+    self.assertTrue(monitor.window_memory == thistle.RingBuffer.memory(5))
+
+  def test_ring_buffer(self):
+    window = thistle.RingBuffer(4, percentiles=True)
+    for i, value in enumerate([5, 1, 4, 2, 3, 10]):
+      window.append(value, i)
+    self.assertTrue(window.full())
+    self.assertTrue(list(window.sorted) == [2.0, 3.0, 4.0, 10.0])
+    self.assertTrue(window.average() == 4.75)
+    self.assertTrue(window.percentile(50) == 3.0)
+    self.assertTrue(window.percentile(95) == 10.0)
+    self.assertTrue(window.rate() == 2.0)
+    self.assertTrue(thistle.RingBuffer.memory(4, True) == 4 * 3 * window.ITEM_SIZE)
+
+# }}}
+
+# CommandRunner {{{
+class TestCommandRunner(unittest.TestCase):
+  def test_run(self):
+    runner = thistle.CommandRunner(timeout=5, max_output=1024, max_concurrency=2)
+    self.assertTrue(b_("foo\n") == runner.run("echo foo"))
+    self.assertRaises(subprocess.CalledProcessError, runner.run, "exit 3")
+    started_at = time.time()
+    self.assertRaises(thistle.CommandTimeoutError, runner.run, "(sleep 30; echo foo) | cat", 0.3)
+    self.assertTrue(time.time() - started_at < 5)
+    self.assertRaises(thistle.CommandOutputError, runner.run, ["yes"])
+    stats = runner.stats()
+    self.assertTrue(stats["echo foo"]["count"] == 1)
+    self.assertTrue(stats["exit 3"]["errors"] == 1)
+    self.assertTrue(stats["(sleep 30; echo foo) | cat"]["timeouts"] == 1)
+    self.assertTrue(stats["yes"]["errors"] == 1)
+    self.assertTrue(runner.running == 0)
+
+  @unittest.skipIf(thistle.asyncio is None, "requires asyncio")
+  def test_async_run(self):
+    runner = thistle.CommandRunner(timeout=5, max_output=1024, max_concurrency=1)
+    loop = thistle.asyncio.new_event_loop()
+    try:
+      futures = [runner.async_run("echo foo", loop) for i in irange(3)]
+      for future in futures:
+        self.assertTrue(b_("foo\n") == loop.run_until_complete(future))
+      future = runner.async_run("(sleep 30; echo foo) | cat", loop, 0.3)
+      self.assertRaises(thistle.CommandTimeoutError, loop.run_until_complete, future)
+      future = runner.async_run(["yes"], loop)
+      self.assertRaises(thistle.CommandOutputError, loop.run_until_complete, future)
+    finally:
+      loop.close()
+    self.assertTrue(runner.stats()["echo foo"]["count"] == 3)
+    self.assertTrue(runner.running == 0)
+
 # }}}
     
 # LogMonitor {{{
@@ -462,6 +854,785 @@ class TestLogMonitor(BaseTestCase):
     expected_log = "foo has occurred.(warn3)"
     self.assertTrue(len(line_contains(log_content, expected_log)) == 1)
 
+  def test_checkpoint(self):
+    config = BASE_CONFIG.copy()
+    config.update({
+      "monitors": [
+        (LogMonitor, {
+          "interval": 60,
+          "file": TEST_DIR + "/monitor.log",
+          "checkpoint_lines": 1000,
+          "targets": [
+            {"pattern": ".*hoge.*",
+             "message": "hoge has occurred."}
+          ]
+        }),
+      ]
+    })
+
+    with open(TEST_DIR+"/monitor.log", "w") as io:
+      for i in irange(3500):
+        io.write("line {}\n".format(i))
+
+    thistle.KERNEL = thistle.Kernel(config)
+    thistle.KERNEL.start(loop=False)
+    time.sleep(1)
+    thistle.KERNEL.shutdown()
+    conn = sqlite3.connect(thistle.DBThread.db_file)
+    try:
+      seek = conn.execute("select seek from file_stat where file=?", (TEST_DIR + "/monitor.log",)).fetchone()[0]
+    finally:
+      conn.close()
+    self.assertTrue(seek == os.path.getsize(TEST_DIR + "/monitor.log"))
+
+  def test_log_file(self):
+    path = TEST_DIR + "/monitor.log"
+    with open(path, "wb") as io:
+      io.write(l_("foo 1\nbar 2\n\xe3\x81\x82 foo 3\nbaz 4\nfoo 5"))
+    prefilter = PatternSet([".*foo.*"], method="match").bytes_prefilter("utf8")
+    for mmap_size in (thistle.LogFile.MMAP_SIZE, 1):
+      logfile = thistle.LogFile(path)
+      logfile.open()
+      try:
+        thistle.LogFile.MMAP_SIZE, mmap_size = mmap_size, thistle.LogFile.MMAP_SIZE
+        lines = [(logfile.decode(v), logfile.position) for v in logfile.lines(prefilter)]
+      finally:
+        thistle.LogFile.MMAP_SIZE = mmap_size
+        logfile.close()
+      self.assertTrue(lines == [(u_("foo 1\n"), 6), (u_(l_("\xe3\x81\x82 foo 3\n")), 22)])
+      self.assertTrue(logfile.position == 28)
+    logfile.open()
+    logfile.position = 22
+    self.assertTrue([v for v in logfile.lines()] == [b_("baz 4\n")])
+    self.assertTrue([v for v in logfile.lines(final=True)] == [b_("foo 5")])
+    self.assertTrue(logfile.position == 33)
+    logfile.close()
+    self.assertTrue(PatternSet([".*foo.*"]).bytes_prefilter("utf-16") is None)
+    self.assertTrue(PatternSet([".*foo.*", ".*"]).bytes_prefilter("utf8") is None)
+
+  @unittest.skipIf(thistle.Inotify.load() is None, "requires inotify")
+  def test_inotify(self):
+    config = BASE_CONFIG.copy()
+    config.update({
+      "monitors": [
+        (LogMonitor, {
+          "interval": 60,
+          "file": TEST_DIR + "/monitor.log",
+          "inotify": True,
+          "targets": [
+            {"pattern": ".*hoge.*",
+             "message": "hoge has occurred."}
+          ]
+        }),
+      ]
+    })
+
+    with open(TEST_DIR+"/monitor.log", "w") as io:
+      io.write("hoge1\n")
+
+    thistle.KERNEL = thistle.Kernel(config)
+    thistle.KERNEL.start(loop=False)
+    try:
+      time.sleep(0.5)
+      with open(TEST_DIR+"/monitor.log", "a") as io:
+        io.write("hoge2\n")
+      time.sleep(0.5)
+      os.rename(TEST_DIR+"/monitor.log", TEST_DIR+"/monitor.log.1")
+      with open(TEST_DIR+"/monitor.log", "w") as io:
+        io.write("hoge3\n")
+      time.sleep(0.5)
+      # writes to a busy file wake the monitor up at most every inotify_delay secs.
+      monitor = thistle.KERNEL.monitors[0]
+      ticks = []
+      tick = monitor.monitor
+      monitor.monitor = lambda: (ticks.append(time.time()), tick())
+      for i in irange(4, 54):
+        with open(TEST_DIR+"/monitor.log", "a") as io:
+          io.write("hoge{}\n".format(i))
+        time.sleep(0.01)
+      time.sleep(0.5)
+      thistle.KERNEL.shutdown()
+    finally:
+      remove_file_without_exc(TEST_DIR+"/monitor.log.1")
+    self.assertTrue(2 <= len(ticks) <= 6)
+    log_content = read_logcontent()
+    for i in irange(1, 54):
+      expected_log = "hoge has occurred.(hoge{})".format(i)
+      self.assertTrue(len(line_contains(log_content, expected_log)) == 1)
+
+  def test_glob_log_monitor(self):
+    log_dir = TEST_DIR + "/glob_logs"
+    if not os.path.exists(log_dir):
+      os.mkdir(log_dir)
+    config = BASE_CONFIG.copy()
+    config.update({
+      "monitors": [
+        (GlobLogMonitor, {
+          "interval": 0.2,
+          "files": [log_dir + "/*.log"],
+          "max_open_files": 2,
+          "targets": [
+            {"pattern": ".*hoge.*",
+             "message": "hoge has occurred."}
+          ]
+        }),
+      ]
+    })
+    try:
+      for i in irange(4):
+        with open("{}/{}.log".format(log_dir, i), "w") as io:
+          io.write("hoge{}\n".format(i))
+      thistle.KERNEL = thistle.Kernel(config)
+      thistle.KERNEL.start(loop=False)
+      time.sleep(0.5)
+      for i in irange(5):
+        with open("{}/{}.log".format(log_dir, i), "a") as io:
+          io.write("hoge{}\n".format(i + 10))
+      time.sleep(0.5)
+      self.assertTrue(len(thistle.KERNEL.monitors[0].opened) <= 2)
+      thistle.KERNEL.shutdown()
+    finally:
+      for i in irange(5):
+        remove_file_without_exc("{}/{}.log".format(log_dir, i))
+      os.rmdir(log_dir)
+    log_content = read_logcontent()
+    for i in list(irange(4)) + list(irange(10, 15)):
+      expected_log = "hoge has occurred.(hoge{})".format(i)
+      self.assertTrue(len(line_contains(log_content, expected_log)) == 1)
+
+  def test_glob_compressed(self):
+    import gzip
+    log_dir = TEST_DIR + "/glob_logs"
+    if not os.path.exists(log_dir):
+      os.mkdir(log_dir)
+    config = BASE_CONFIG.copy()
+    config.update({
+      "monitors": [
+        (GlobLogMonitor, {
+          "interval": 0.2,
+          "files": [log_dir + "/app.log*"],
+          "max_open_files": 1,
+          "targets": [
+            {"pattern": ".*hoge.*",
+             "message": "hoge has occurred."}
+          ]
+        }),
+      ]
+    })
+    try:
+      # the uncompressed stream is much longer than the file.
+      with gzip.open(log_dir + "/app.log.1.gz", "wb") as io:
+        io.write(b_("foo\n" * 10000 + "hoge1\n"))
+      with open(log_dir + "/app.log", "w") as io:
+        io.write("foo\n")
+      for i in irange(2):
+        thistle.KERNEL = thistle.Kernel(config)
+        thistle.KERNEL.start(loop=False)
+        time.sleep(1.5)
+        thistle.KERNEL.shutdown()
+    finally:
+      remove_file_without_exc(log_dir + "/app.log.1.gz")
+      remove_file_without_exc(log_dir + "/app.log")
+      os.rmdir(log_dir)
+    log_content = read_logcontent()
+    self.assertTrue(len(line_contains(log_content, "hoge has occurred.(hoge1)")) == 1)
+    self.assertTrue(len(line_contains(log_content, "was truncated")) == 0)
+
+  def test_archives(self):
+    import gzip
+    config = BASE_CONFIG.copy()
+    config.update({
+      "monitors": [
+        (LogMonitor, {
+          "interval": 60,
+          "file": TEST_DIR + "/monitor.log",
+          "archives": [TEST_DIR + "/archive*.gz"],
+          "max_tick_lines": 10,
+          "targets": [
+            {"pattern": ".*hoge.*",
+             "message": "hoge has occurred."}
+          ]
+        }),
+      ]
+    })
+    with open(TEST_DIR + "/monitor.log", "w") as io:
+      io.write("foo\n")
+    with gzip.open(TEST_DIR + "/archive.gz", "wb") as io:
+      io.write(b_("".join("hoge{}\n".format(i) for i in irange(50))))
+    try:
+      for i in irange(3):
+        # a renamed archive is not read again, and a removed one is forgotten.
+        if i == 1:
+          os.rename(TEST_DIR + "/archive.gz", TEST_DIR + "/archive.1.gz")
+        elif i == 2:
+          os.remove(TEST_DIR + "/archive.1.gz")
+        thistle.KERNEL = thistle.Kernel(config)
+        thistle.KERNEL.start(loop=False)
+        time.sleep(1)
+        thistle.KERNEL.shutdown()
+    finally:
+      remove_file_without_exc(TEST_DIR + "/archive.gz")
+      remove_file_without_exc(TEST_DIR + "/archive.1.gz")
+    log_content = read_logcontent()
+    for i in irange(50):
+      expected_log = "hoge has occurred.(hoge{})".format(i)
+      self.assertTrue(len(line_contains(log_content, expected_log)) == 1)
+    import sqlite3
+    conn = sqlite3.connect(thistle.DBThread.db_file)
+    try:
+      rows = conn.execute("select file from file_stat where file like 'archive:%'").fetchall()
+    finally:
+      conn.close()
+    self.assertTrue(rows == [])
+
+  def test_compressed_rotation(self):
+    import gzip, bz2
+    path = TEST_DIR + "/monitor.log"
+    config = BASE_CONFIG.copy()
+    config.update({
+      "monitors": [
+        (LogMonitor, {
+          "interval": 60,
+          "file": path,
+          "archives": [TEST_DIR + "/archive*.bz2"],
+          "targets": [
+            {"pattern": ".*hoge.*",
+             "message": "hoge has occurred."}
+          ]
+        }),
+      ]
+    })
+    with open(path, "w") as io:
+      io.write("head\nhoge1\nhoge2\n")
+    try:
+      thistle.KERNEL = thistle.Kernel(config)
+      thistle.KERNEL.start(loop=False)
+      time.sleep(0.5)
+      thistle.KERNEL.shutdown()
+
+      # rotated and compressed while thistle is stopped.
+      with open(path, "a") as io:
+        io.write("hoge3\n")
+      with open(path, "rb") as src:
+        with gzip.open(path + ".1.gz", "wb") as dst:
+          dst.write(src.read())
+      os.remove(path)
+      with open(path, "w") as io:
+        io.write("newhead\nhoge4\n")
+      archive = bz2.BZ2File(TEST_DIR + "/archive.bz2", "wb")
+      archive.write(b_("hoge5\nfoo\nhoge6"))
+      archive.close()
+
+      thistle.KERNEL = thistle.Kernel(config)
+      thistle.KERNEL.start(loop=False)
+      time.sleep(0.5)
+      thistle.KERNEL.shutdown()
+    finally:
+      remove_file_without_exc(path + ".1.gz")
+      remove_file_without_exc(TEST_DIR + "/archive.bz2")
+    log_content = read_logcontent()
+    for i in irange(1, 7):
+      expected_log = "hoge has occurred.(hoge{})".format(i)
+      self.assertTrue(len(line_contains(log_content, expected_log)) == 1)
+    self.assertTrue(len(line_contains(log_content, "from " + path + ".1.gz")) == 1)
+
+  def test_aggregate(self):
+    config = BASE_CONFIG.copy()
+    config.update({
+      "monitors": [
+        (LogMonitor, {
+          "interval": 0.2,
+          "file": TEST_DIR + "/monitor.log",
+          "targets": [
+            {"pattern": ".*hoge.*",
+             "message": "hoge has occurred.",
+             "aggregate": 0.5,
+             "samples": 3},
+            {"pattern": ".*warn.*",
+             "message": "foo has occurred.",
+             "rate_limit": 0.001,
+             "burst": 2}
+          ]
+        }),
+      ]
+    })
+
+    with open(TEST_DIR+"/monitor.log", "w") as io:
+      for i in irange(100):
+        io.write("hoge{}\n".format(i))
+        io.write("warn{}\n".format(i))
+
+    thistle.KERNEL = thistle.Kernel(config)
+    thistle.KERNEL.start(loop=False)
+    time.sleep(1)
+    target = thistle.KERNEL.monitors[0].attrs["targets"][0]
+    self.assertTrue(len(target["__samples__"]) == 3)
+    thistle.KERNEL.shutdown()
+    log_content = read_logcontent()
+    self.assertTrue(len(line_contains(log_content, "hoge has occurred.")) == 1)
+    expected_log = "hoge has occurred.(100 lines, first: hoge0, last: hoge99)"
+    self.assertTrue(len(line_contains(log_content, expected_log)) == 1)
+    self.assertTrue(len(line_contains(log_content, "foo has occurred.")) == 2)
+
+  def test_records(self):
+    config = BASE_CONFIG.copy()
+    config.update({
+      "monitors": [
+        (LogMonitor, {
+          "interval": 0.2,
+          "file": TEST_DIR + "/monitor.log",
+          "record_start": "^\\d{4}-",
+          "record_timeout": 0.1,
+          "targets": [
+            {"pattern": ".*ValueError.*",
+             "message": "ValueError has occurred."}
+          ]
+        }),
+      ]
+    })
+
+    with open(TEST_DIR+"/monitor.log", "w") as io:
+      for i in irange(3):
+        io.write("2020-01-0{} ERROR request failed\n".format(i))
+        io.write("Traceback (most recent call last):\n")
+        io.write("  File \"app.py\", line {}\n".format(i))
+        io.write("ValueError: {}\n".format(i))
+      io.write("2020-01-04 INFO done\n")
+
+    thistle.KERNEL = thistle.Kernel(config)
+    thistle.KERNEL.start(loop=False)
+    time.sleep(1)
+    target = thistle.KERNEL.monitors[0].attrs["targets"][0]
+    self.assertTrue(target["__line__"].startswith("2020-01-02 ERROR"))
+    self.assertTrue(target["__line__"].endswith("ValueError: 2"))
+    thistle.KERNEL.shutdown()
+    log_content = read_logcontent()
+    self.assertTrue(len(line_contains(log_content, "ValueError has occurred.")) == 3)
+
+  def test_tick_budget(self):
+    class TickLogMonitor(LogMonitor):
+      # records the position and whether the monitor is behind per tick.
+      def __init__(self, attrs):
+        self.ticks = []
+        LogMonitor.__init__(self, attrs)
+
+      def monitor(self):
+        LogMonitor.monitor(self)
+        self.ticks.append((self.logfile.position, self.behind))
+
+    config = BASE_CONFIG.copy()
+    config.update({
+      "monitors": [
+        (TickLogMonitor, {
+          "interval": 60,
+          "file": TEST_DIR + "/monitor.log",
+          "max_tick_lines": 100,
+          "targets": [
+            {"pattern": ".*hoge.*",
+             "message": "hoge has occurred."}
+          ]
+        }),
+        (LogMonitor, {
+          "interval": 60,
+          "file": TEST_DIR + "/monitor2.log",
+          "max_backlog": 100,
+          "targets": [
+            {"pattern": ".*foo.*",
+             "message": "foo has occurred."}
+          ]
+        }),
+        (TickLogMonitor, {
+          "interval": 60,
+          "file": TEST_DIR + "/monitor3.log",
+          "max_tick_bytes": 1000,
+          "targets": [
+            {"pattern": ".*hoge.*",
+             "message": "hoge has occurred."}
+          ]
+        }),
+      ]
+    })
+
+    with open(TEST_DIR+"/monitor.log", "w") as io:
+      for i in irange(1000):
+        io.write("hoge{}\n".format(i))
+    with open(TEST_DIR+"/monitor2.log", "w") as io:
+      for i in irange(1000):
+        io.write("foo{}\n".format(i))
+    # the prefilter finds no lines in this file.
+    with open(TEST_DIR+"/monitor3.log", "w") as io:
+      for i in irange(1000):
+        io.write("bar{}\n".format(i))
+
+    thistle.KERNEL = thistle.Kernel(config)
+    thistle.KERNEL.start(loop=False)
+    time.sleep(1)
+    size = os.path.getsize(TEST_DIR + "/monitor.log")
+    ticks = thistle.KERNEL.monitors[0].ticks
+    self.assertTrue(ticks[0][0] < size and ticks[0][1])
+    self.assertTrue(ticks[-1] == (size, False))
+    self.assertTrue(len(ticks) > 10)
+    stats = thistle.KERNEL.monitors[0].stats()
+    self.assertTrue(stats[TEST_DIR + "/monitor.log"]["backlog"] == 0)
+    size = os.path.getsize(TEST_DIR + "/monitor3.log")
+    ticks = thistle.KERNEL.monitors[2].ticks
+    self.assertTrue(0 < ticks[0][0] <= 1000 and ticks[0][1])
+    self.assertTrue(ticks[-1] == (size, False))
+    stats = thistle.KERNEL.monitors[1].stats()
+    self.assertTrue(stats[TEST_DIR + "/monitor2.log"]["skipped"] == os.path.getsize(TEST_DIR + "/monitor2.log"))
+    thistle.KERNEL.shutdown()
+    remove_file_without_exc(TEST_DIR + "/monitor2.log")
+    remove_file_without_exc(TEST_DIR + "/monitor3.log")
+    log_content = read_logcontent()
+    self.assertTrue(len(line_contains(log_content, "hoge has occurred.")) == 1000)
+    self.assertTrue(len(line_contains(log_content, "foo has occurred.")) == 0)
+    self.assertTrue(len(line_contains(log_content, "Skipped")) == 1)
+
+  def test_deadline(self):
+    for i, mode in enumerate(["thread", "scheduler"]):
+      config = BASE_CONFIG.copy()
+      config.update({
+        "mode": mode,
+        "monitors": [
+          (LogMonitor, {
+            "interval": 60,
+            "file": TEST_DIR + "/monitor.log",
+            "targets": [
+              {"pattern": ".*hoge.*",
+               "message": "hoge has occurred.",
+               "aggregate": 0.3}
+            ]
+          }),
+          (LogMonitor, {
+            "interval": 60,
+            "file": TEST_DIR + "/monitor2.log",
+            "record_start": "^\\d{4}-",
+            "record_timeout": 0.3,
+            "targets": [
+              {"pattern": "(?i).*valueerror.*",
+               "message": "ValueError has occurred."}
+            ]
+          }),
+        ]
+      })
+      with open(TEST_DIR+"/monitor.log", "w") as io:
+        io.write("hoge1\nhoge2\n")
+      with open(TEST_DIR+"/monitor2.log", "w") as io:
+        io.write("2020-01-01 ERROR\nValueError: 1\n")
+
+      thistle.KERNEL = thistle.Kernel(config)
+      thistle.KERNEL.start(loop=False)
+      time.sleep(1)
+      # sent before the next interval.
+      log_content = read_logcontent()
+      thistle.KERNEL.shutdown()
+      remove_file_without_exc(TEST_DIR + "/monitor2.log")
+      remove_file_without_exc(thistle.DBThread.db_file)
+      self.assertTrue(len(line_contains(log_content, "hoge has occurred.(2 lines")) == i + 1)
+      self.assertTrue(len(line_contains(log_content, "ValueError has occurred.")) == i + 1)
+
+  def test_rate_limited(self):
+    messages = []
+    callback = thistle.RateLimited(lambda level, message, target: messages.append(message), 0.001, 2)
+    for i in irange(5):
+      callback(Event.ERROR, "message{}".format(i), None)
+    callback.bucket.tokens = 1
+    callback(Event.ERROR, "message5", None)
+    self.assertTrue(messages == ["message0", "message1", "message5 (3 events were suppressed)"])
+
+    # a dropped state change is sent when the bucket has a token again.
+    class Monitor(object):
+      attrs = {"messages": {"gt": "gt", "normal": "normal"}}
+      def callback(self, level, message, target):
+        messages.append(message)
+    messages = []
+    target = thistle.Target(Monitor(), {"rate_limit": 0.001, "burst": 1})
+    target.change_state("gt", Event.ERROR)
+    target.change_state("normal", Event.INFO)
+    self.assertTrue(target["__state__"] == "gt")
+    target["__bucket__"].tokens = 1
+    target.change_state("normal", Event.INFO)
+    self.assertTrue(messages == ["[Monitor] gt", "[Monitor] normal"])
+
+  def test_rotation(self):
+    config = BASE_CONFIG.copy()
+    config.update({
+      "monitors": [
+        (LogMonitor, {
+          "interval": 1,
+          "file": TEST_DIR + "/monitor.log",
+          "targets": [
+            {"pattern": ".*hoge.*",
+             "message": "hoge has occurred."}
+          ]
+        }),
+      ]
+    })
+
+    with open(TEST_DIR+"/monitor.log", "w") as io:
+      io.write("hoge1\n")
+
+    thistle.KERNEL = thistle.Kernel(config)
+    thistle.KERNEL.start(loop=False)
+    try:
+      time.sleep(0.5)
+      # lines written just before the rotation are read from the old file.
+      with open(TEST_DIR+"/monitor.log", "a") as io:
+        io.write("hoge2\n")
+      os.rename(TEST_DIR+"/monitor.log", TEST_DIR+"/monitor.log.1")
+      with open(TEST_DIR+"/monitor.log", "w") as io:
+        io.write("hoge3\n")
+      time.sleep(1.5)
+      thistle.KERNEL.shutdown()
+    finally:
+      remove_file_without_exc(TEST_DIR+"/monitor.log.1")
+    log_content = read_logcontent()
+    for i in irange(1, 4):
+      expected_log = "hoge has occurred.(hoge{})".format(i)
+      self.assertTrue(len(line_contains(log_content, expected_log)) == 1)
+    self.assertTrue(len(line_contains(log_content, "monitor.log was rotated.")) == 1)
+
+  def test_rotation_budget(self):
+    config = BASE_CONFIG.copy()
+    config.update({
+      "monitors": [
+        (LogMonitor, {
+          "interval": 1,
+          "file": TEST_DIR + "/monitor.log",
+          "max_tick_lines": 10,
+          "targets": [
+            {"pattern": ".*hoge.*",
+             "message": "hoge has occurred."}
+          ]
+        }),
+      ]
+    })
+
+    with open(TEST_DIR+"/monitor.log", "w") as io:
+      io.write("head\n")
+
+    thistle.KERNEL = thistle.Kernel(config)
+    thistle.KERNEL.start(loop=False)
+    try:
+      time.sleep(0.5)
+      # the rotated file is drained in slices before the new one is read.
+      with open(TEST_DIR+"/monitor.log", "a") as io:
+        for i in irange(100):
+          io.write("hoge{}\n".format(i))
+      os.rename(TEST_DIR+"/monitor.log", TEST_DIR+"/monitor.log.1")
+      with open(TEST_DIR+"/monitor.log", "w") as io:
+        io.write("hoge_new\n")
+      time.sleep(1.5)
+      thistle.KERNEL.shutdown()
+    finally:
+      remove_file_without_exc(TEST_DIR+"/monitor.log.1")
+    log_content = read_logcontent()
+    lines = line_contains(log_content, "hoge has occurred.")
+    self.assertTrue(len(lines) == 101)
+    self.assertTrue("hoge_new" in lines[-1])
+    for i in irange(100):
+      expected_log = "hoge has occurred.(hoge{})".format(i)
+      self.assertTrue(len(line_contains(log_content, expected_log)) == 1)
+
+# }}}
+
+# Watcher {{{
+class TestWatcher(BaseTestCase):
+  def test_pidfd_fallback(self):
+    import errno, subprocess
+    def pidfd_open(pid):
+      raise OSError(errno.ENOSYS, "Function not implemented")
+    original = getattr(os, "pidfd_open", None)
+    os.pidfd_open = pidfd_open
+    watcher = thistle.Watcher(0.1)
+    watcher.start()
+    exited = []
+    try:
+      process = subprocess.Popen(["sleep", "0.3"])
+      watcher.watch_pid("sleep", process.pid, exited.append)
+      time.sleep(0.1)
+      self.assertTrue(exited == [])
+      process.wait()
+      time.sleep(0.5)
+    finally:
+      watcher.stop()
+      if original is None:
+        del os.pidfd_open
+      else:
+        os.pidfd_open = original
+    self.assertTrue(exited == [process.pid])
+
+# }}}
+
+# DBThread {{{
+class TestDBThread(BaseTestCase):
+  def test_batch(self):
+    db_thread = thistle.DBThread()
+    db_thread.start()
+    def insert(file):
+      def f(conn):
+        conn.execute("insert into file_stat values (?, ?, ?)", (file, 0, ""))
+        return file
+      return f
+    def fail(conn):
+      conn.execute("insert into file_stat values (?, ?, ?)", ("failed", 0, ""))
+      raise ValueError("failed")
+    futures = [db_thread.execute(insert("file{}".format(i)), sync=False) for i in irange(10)]
+    failed = db_thread.execute(fail, sync=False)
+    done = []
+    failed.add_done_callback(done.append)
+    files = db_thread.execute(lambda conn: [v[0] for v in conn.execute("select file from file_stat")])
+    mode = db_thread.execute(lambda conn: conn.execute("PRAGMA journal_mode").fetchone()[0])
+    stats = db_thread.stats()
+    db_thread.stop()
+    self.assertTrue([v.result() for v in futures] == ["file{}".format(i) for i in irange(10)])
+    self.assertRaises(ValueError, failed.result)
+    self.assertTrue(done == [failed])
+    self.assertTrue(files == ["file{}".format(i) for i in irange(10)])
+    self.assertTrue(mode == "wal")
+    self.assertTrue(stats["items"] >= 12 and stats["count"] <= stats["items"])
+    self.assertTrue(stats["queue_depth"] == 0)
+
+  def test_migrate(self):
+    conn = sqlite3.connect(thistle.DBThread.db_file)
+    conn.execute("create table file_stat (file text, seek int, header text)")
+    conn.executemany("insert into file_stat values (?, ?, ?)",
+                     [("a.log", 1, "a"), ("b.log", 2, "b"), ("a.log", 3, "a")])
+    conn.commit()
+    conn.close()
+    db_thread = thistle.DBThread()
+    db_thread.start()
+    self.assertTrue(db_thread.saved_checkpoint("a.log") == (3, "a"))
+    self.assertTrue(db_thread.saved_checkpoint("c.log") is None)
+    db_thread.checkpoint("a.log", 4, "a")
+    db_thread.checkpoint("c.log", 5, "c")
+    db_thread.stop()
+    conn = sqlite3.connect(thistle.DBThread.db_file)
+    try:
+      version = conn.execute("PRAGMA user_version").fetchone()[0]
+      rows = conn.execute("select file, seek from file_stat order by file").fetchall()
+      self.assertRaises(sqlite3.IntegrityError, conn.execute, "insert into file_stat values ('b.log', 0, '')")
+    finally:
+      conn.close()
+    self.assertTrue(version == len(thistle.DBThread.MIGRATIONS))
+    self.assertTrue(rows == [("a.log", 4), ("b.log", 2), ("c.log", 5)])
+
+# }}}
+
+# TimeSeriesStore {{{
+class TestTimeSeriesStore(BaseTestCase):
+  def test_store(self):
+    config = BASE_CONFIG.copy()
+    config.update({
+      "monitors": [
+        (CommandOutputVarMonitor, {
+          "interval": 0.1,
+          "command": lambda: {"var1": 1, "var2": 2.5},
+          "store": True,
+          "targets": []
+        }),
+      ]
+    })
+    thistle.KERNEL = thistle.Kernel(config)
+    thistle.KERNEL.start(loop=False)
+    time.sleep(1)
+    thistle.KERNEL.shutdown()
+
+    db_thread = thistle.DBThread()
+    db_thread.start()
+    store = thistle.TimeSeriesStore(db_thread)
+    try:
+      self.check_store(store)
+    finally:
+      db_thread.stop()
+
+  def check_store(self, store):
+    now = time.time()
+    samples = store.query("var2", now - 60, now)
+    self.assertTrue(len(samples) >= 5 and all(v[1] == 2.5 for v in samples))
+    rollups = store.query("var1", now - 7200, now, 3600)
+    self.assertTrue(len(rollups) in (1, 2) and rollups[0][1:] == (1, 1, 1.0))
+
+    base = int(now // 3600) * 3600 - 7200
+    for i in irange(10):
+      store.append("var3", i, base + i * 60)
+    self.assertTrue(store.query("var3", base, base + 3600, 300) == [(base, 0, 4, 2.0), (base + 300, 5, 9, 7.0)])
+    store.flush(force=True)
+    self.assertTrue(store.query("var3", base, base + 3600, 3600) == [(base, 0, 9, 4.5)])
+    self.assertTrue(len(store.query("var3", base, base + 3600)) == 10)
+    store.retention["samples_raw"] = 3600
+    store.pruned_at = 0
+    store.append("var3", 10, base + 600)
+    store.flush(force=True)
+    self.assertTrue(store.query("var3", base, base + 3600) == [])
+    self.assertTrue(store.query("var3", base, base + 3600, 3600) == [(base, 0, 10, 5.0)])
+    self.assertRaises(ValueError, store.query, "var3", base, base + 3600, 10)
+
+# }}}
+
+# Kernel {{{
+class TestKernel(BaseTestCase):
+  def test_scheduler_mode(self):
+    config = BASE_CONFIG.copy()
+    config.update({
+      "mode": "scheduler",
+      "workers": 2,
+      "monitors": [
+        (DummyProcessMonitorSleep2, {
+          "interval": 3,
+          "targets": [
+            {"name": "sleep process{}".format(i),
+             "pattern": ".*sleep.*",
+             "min": 1,
+             "max": 1}
+          ]
+        }) for i in irange(50)
+      ]
+    })
+    thistle.KERNEL = thistle.Kernel(config)
+    thistle.KERNEL.start(loop=False)
+    time.sleep(1)
+    self.assertTrue(len(thistle.KERNEL.scheduler.workers) == 2)
+    self.assertTrue(all(w.is_alive() for w in thistle.KERNEL.scheduler.workers))
+    self.assertTrue(not any(m.is_alive() for m in thistle.KERNEL.monitors))
+    thistle.KERNEL.shutdown()
+    log_content = read_logcontent()
+    expected_log = ": 2 process(> 1)"
+    self.assertTrue(len(line_contains(log_content, expected_log)) == 50)
+
+  @unittest.skipIf(thistle.asyncio is None, "requires asyncio")
+  def test_async_kernel(self):
+    config = BASE_CONFIG.copy()
+    config.update({
+      "monitors": [
+        (DummyProcessMonitorSleep2, {
+          "interval": 3,
+          "targets": [
+            {"name": "sleep process",
+             "pattern": ".*sleep.*",
+             "min": 1,
+             "max": 1}
+          ]
+        }),
+        (CommandOutputVarMonitor, {
+          "interval": 3,
+          "command": "echo CPU_USAGE=100",
+          "targets": [
+            {"name": "CPU_USAGE",
+             "gt": 90}
+          ]
+        }),
+      ]
+    })
+    thistle.KERNEL = thistle.AsyncKernel(config)
+    thistle.KERNEL.start(loop=False)
+    time.sleep(1)
+    thistle.KERNEL.shutdown()
+    log_content = read_logcontent()
+    expected_log = "ERROR: [DummyProcessMonitorSleep2] sleep process: 2 process(> 1)"
+    self.assertTrue(len(line_contains(log_content, expected_log)) == 1)
+    expected_log = "ERROR: [CommandOutputVarMonitor] CPU_USAGE: 100 (> 90)"
+    self.assertTrue(len(line_contains(log_content, expected_log)) == 1)
 # }}}
 
 if __name__ == '__main__':
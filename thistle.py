@@ -36,6 +36,7 @@ __license__ = 'MIT'
 import os
 import os.path
 import sys
+import errno
 import re
 import subprocess
 import threading
@@ -44,12 +45,53 @@ import time
 import logging
 import sqlite3
 import codecs
+import heapq
+import select
+import collections
+import array
+import bisect
+import math
+import fnmatch
+import random
+import glob
+import gzip
+import struct
 from datetime import datetime
+try:
+  import pwd
+except ImportError:
+  pwd = None
+try:
+  import mmap
+except ImportError:
+  mmap = None
+try:
+  import ctypes
+  import ctypes.util
+except ImportError:
+  ctypes = None
+try:
+  import bz2
+except ImportError:
+  bz2 = None
+try:
+  import lzma
+except ImportError:
+  lzma = None
+try:
+  from re import _parser as sre_parse
+except ImportError:
+  import sre_parse
+try:
+  import asyncio
+except ImportError:
+  asyncio = None
 
 from compat import *
 
 # module globals {{{
 STOP_THREAD = "STOP_THREAD"
+WAKEUP_THREAD = "WAKEUP_THREAD"
 FILE_PATH = os.path.abspath(__file__)
 if os.path.islink(FILE_PATH):
   FILE_PATH = os.readlink(FILE_PATH)
@@ -61,8 +103,221 @@ def with_defaults(default, values, copy=True):
   options.update(values)
   return options
 
-def p_out(cmd):
-  return subprocess.check_output(cmd, shell=(not isinstance(cmd, (list, tuple))))
+# commands run in their own session to be killed with their children.
+# preexec_fn is not safe in threads and is used only on Python 2.
+NEW_SESSION = {"start_new_session": True} if PY3 else {"preexec_fn": os.setsid}
+
+def p_out(cmd, timeout=None, max_output=None):
+  return COMMAND_RUNNER.run(cmd, timeout, max_output)
+
+def future_then(future, func, loop):
+  result = loop.create_future()
+  def copy(f):
+    if f.cancelled():
+      result.cancel()
+    elif f.exception() is not None:
+      result.set_exception(f.exception())
+    else:
+      result.set_result(f.result())
+  def callback(f):
+    if f.cancelled() or f.exception() is not None:
+      return copy(f)
+    try:
+      value = func(f.result())
+    except Exception as e:
+      return result.set_exception(e)
+    if asyncio.isfuture(value):
+      value.add_done_callback(copy)
+    else:
+      result.set_result(value)
+  asyncio.ensure_future(future, loop=loop).add_done_callback(callback)
+  return result
+
+def async_p_out(cmd, loop, timeout=None, max_output=None):
+  return COMMAND_RUNNER.async_run(cmd, loop, timeout, max_output)
+# }}}
+
+class CommandTimeoutError(Exception): pass
+class CommandOutputError(Exception): pass
+
+class CommandRunner(object): # {{{
+  CHUNK_SIZE = 65536
+
+  def __init__(self, timeout=60, max_output=16*1024*1024, max_concurrency=16):
+    self.condition = threading.Condition()
+    self.running = 0
+    self.waiters = collections.deque()
+    self.durations = {}
+    self.configure(timeout, max_output, max_concurrency)
+
+  def configure(self, timeout=60, max_output=16*1024*1024, max_concurrency=16):
+    self.timeout = timeout
+    self.max_output = max_output
+    self.max_concurrency = max_concurrency
+
+  def acquire(self):
+    with self.condition:
+      while self.max_concurrency and self.running >= self.max_concurrency:
+        self.condition.wait()
+      self.running += 1
+
+  def async_acquire(self, loop):
+    future = loop.create_future()
+    with self.condition:
+      if not self.max_concurrency or self.running < self.max_concurrency:
+        self.running += 1
+        future.set_result(None)
+      else:
+        self.waiters.append((loop, future))
+    return future
+
+  def release(self):
+    with self.condition:
+      if self.waiters:
+        # hands the slot over to a waiting event loop.
+        loop, future = self.waiters.popleft()
+        loop.call_soon_threadsafe(self.grant, future)
+      else:
+        self.running -= 1
+        self.condition.notify()
+
+  def grant(self, future):
+    if future.cancelled():
+      self.release()
+    else:
+      future.set_result(None)
+
+  def kill(self, process):
+    try:
+      os.killpg(process.pid, signal.SIGKILL)
+    except OSError:
+      pass
+
+  def limits(self, timeout, max_output):
+    return (self.timeout if timeout is None else timeout,
+            self.max_output if max_output is None else max_output)
+
+  def run(self, cmd, timeout=None, max_output=None):
+    timeout, max_output = self.limits(timeout, max_output)
+    self.acquire()
+    try:
+      started_at = time.time()
+      process = subprocess.Popen(cmd, shell=(not isinstance(cmd, (list, tuple))),
+                                 stdout=subprocess.PIPE, close_fds=True, **NEW_SESSION)
+      try:
+        output, error = self.communicate(process, timeout and started_at + timeout, max_output)
+      finally:
+        process.stdout.close()
+      return self.finish(cmd, started_at, error, process.returncode, output, timeout, max_output)
+    finally:
+      self.release()
+
+  def communicate(self, process, deadline, max_output):
+    fd = process.stdout.fileno()
+    poller = select.poll()
+    poller.register(fd, select.POLLIN)
+    output, size, error = [], 0, None
+    while True:
+      wait = None
+      if deadline:
+        wait = deadline - time.time()
+        if wait <= 0:
+          error = "timeout"
+          break
+      try:
+        if not poller.poll(None if wait is None else int(wait * 1000) + 1):
+          continue
+      except (select.error, OSError) as e:
+        if e.args[0] == errno.EINTR:
+          continue
+        raise
+      data = os.read(fd, CommandRunner.CHUNK_SIZE)
+      if not data:
+        break
+      output.append(data)
+      size += len(data)
+      if max_output and size > max_output:
+        error = "output"
+        break
+    # the command may close its stdout before it exits.
+    while error is None and process.poll() is None:
+      if deadline and time.time() >= deadline:
+        error = "timeout"
+      time.sleep(0.01)
+    if error is not None:
+      self.kill(process)
+    process.wait()
+    return b_("").join(output), error
+
+  def async_run(self, cmd, loop, timeout=None, max_output=None):
+    timeout, max_output = self.limits(timeout, max_output)
+    def spawn(_):
+      started_at = time.time()
+      if isinstance(cmd, (list, tuple)):
+        spawned = asyncio.create_subprocess_exec(*cmd, stdout=subprocess.PIPE, start_new_session=True)
+      else:
+        spawned = asyncio.create_subprocess_shell(cmd, stdout=subprocess.PIPE, start_new_session=True)
+      result = future_then(spawned, lambda process: self.async_communicate(
+        process, cmd, started_at, timeout, max_output, loop), loop)
+      result.add_done_callback(lambda f: self.release())
+      return result
+    return future_then(self.async_acquire(loop), spawn, loop)
+
+  def async_communicate(self, process, cmd, started_at, timeout, max_output, loop):
+    state = {"output": [], "size": 0, "error": None}
+    def kill(error):
+      if state["error"] is None:
+        state["error"] = error
+        self.kill(process)
+    timer = timeout and loop.call_later(timeout, kill, "timeout")
+    def check(returncode):
+      if timer:
+        timer.cancel()
+      return self.finish(cmd, started_at, state["error"], returncode,
+                         b_("").join(state["output"]), timeout, max_output)
+    def read(data):
+      if not data:
+        return future_then(process.wait(), check, loop)
+      if state["error"] is None:
+        state["output"].append(data)
+        state["size"] += len(data)
+        if max_output and state["size"] > max_output:
+          kill("output")
+      return future_then(process.stdout.read(CommandRunner.CHUNK_SIZE), read, loop)
+    return future_then(process.stdout.read(CommandRunner.CHUNK_SIZE), read, loop)
+
+  def finish(self, cmd, started_at, error, returncode, output, timeout, max_output):
+    self.record(cmd, time.time() - started_at, error or (returncode and "error"))
+    if error == "timeout":
+      raise CommandTimeoutError("Command {} timed out after {} secs.".format(cmd, timeout))
+    if error == "output":
+      raise CommandOutputError("Command {} wrote more than {} bytes.".format(cmd, max_output))
+    if returncode:
+      raise subprocess.CalledProcessError(returncode, cmd, output)
+    return output
+
+  def record(self, cmd, duration, error):
+    key = u_(" ").join(imap(u_, cmd)) if isinstance(cmd, (list, tuple)) else u_(cmd)
+    with self.condition:
+      stat = self.durations.get(key)
+      if stat is None:
+        stat = self.durations[key] = {"count": 0, "errors": 0, "timeouts": 0,
+                                      "total": 0.0, "max": 0.0, "last": 0.0}
+      stat["count"] += 1
+      if error == "timeout":
+        stat["timeouts"] += 1
+      elif error:
+        stat["errors"] += 1
+      stat["total"] += duration
+      stat["max"] = max(stat["max"], duration)
+      stat["last"] = duration
+
+  def stats(self):
+    with self.condition:
+      return dict((key, dict(stat, avg=stat["total"] / stat["count"]))
+                  for key, stat in iter_items(self.durations))
+
+COMMAND_RUNNER = CommandRunner()
 # }}}
 
 class Event(object): # {{{
@@ -121,47 +376,337 @@ class EventThread(BaseThread): # {{{
         pass
 # }}}
 
+class DBFuture(object): # {{{
+  __slots__ = ("lock", "event", "value", "error", "callbacks")
+
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.event = threading.Event()
+    self.value = None
+    self.error = None
+    self.callbacks = []
+
+  def set_result(self, value, error=None):
+    with self.lock:
+      self.value = value
+      self.error = error
+      self.event.set()
+      callbacks, self.callbacks = self.callbacks, None
+    for callback in callbacks:
+      self.run_callback(callback)
+
+  def run_callback(self, callback):
+    try:
+      callback(self)
+    except Exception as e:
+      LOGGER.error("Failed to execute a callback: {}".format(u_(e)))
+
+  def done(self):
+    return self.event.is_set()
+
+  def add_done_callback(self, callback):
+    # callbacks run on the db thread, asyncio callers should use
+    # loop.call_soon_threadsafe.
+    with self.lock:
+      if self.callbacks is not None:
+        self.callbacks.append(callback)
+        return
+    self.run_callback(callback)
+
+  def result(self):
+    self.event.wait()
+    if self.error is not None:
+      raise self.error
+    return self.value
+# }}}
+
 class DBThread(BaseThread): # {{{
   db_file = os.path.join(PATH, "dat", "thistle.db")
+  MAX_BATCH = 256
+  # statements to upgrade the schema from version i to i+1.
+  MIGRATIONS = [
+    ["create table if not exists file_stat (file text, seek int, header text)"],
+    ["delete from file_stat where rowid not in (select max(rowid) from file_stat group by file)",
+     "create unique index if not exists file_stat_file on file_stat (file)"],
+    ["create table if not exists vars (id integer primary key, name text unique)",
+     "create table if not exists samples_raw (var int, t real, value real)",
+     "create index if not exists samples_raw_var_t on samples_raw (var, t)",
+     "create index if not exists samples_raw_t on samples_raw (t)",
+     "create table if not exists rollup_1m (var int, t int, min real, max real, sum real, count int, primary key (var, t))",
+     "create table if not exists rollup_5m (var int, t int, min real, max real, sum real, count int, primary key (var, t))",
+     "create table if not exists rollup_1h (var int, t int, min real, max real, sum real, count int, primary key (var, t))"],
+  ]
+
+  def __init__(self):
+    BaseThread.__init__(self)
+    self.lock = threading.Lock()
+    self.loaded = threading.Event()
+    self.saved = {}
+    self.checkpoints = {}
+    self.flush_pending = False
+    self.durations = {"count": 0, "items": 0, "total": 0.0, "max": 0.0, "last": 0.0}
+
+  def checkpoint(self, file, seek, header):
+    with self.lock:
+      self.checkpoints[file] = self.saved[file] = (seek, header)
+
+  def saved_checkpoint(self, file):
+    # returns (seek, header) of the file, or None.
+    self.loaded.wait()
+    with self.lock:
+      return self.saved.get(file)
+
+  def saved_checkpoints(self, prefix):
+    # returns (file, seek, header) of the files that start with the prefix.
+    self.loaded.wait()
+    with self.lock:
+      return [(file, seek, header) for file, (seek, header) in iter_items(self.saved) if file.startswith(prefix)]
+
+  def remove_checkpoints(self, files):
+    with self.lock:
+      for file in files:
+        self.saved.pop(file, None)
+        self.checkpoints.pop(file, None)
+    if files:
+      files = [(v,) for v in files]
+      self.execute(lambda conn: conn.executemany("delete from file_stat where file = ?", files), sync=False)
+
+  def load_checkpoints(self, conn):
+    rows = conn.execute("select file, seek, header from file_stat").fetchall()
+    with self.lock:
+      for file, seek, header in rows:
+        self.saved.setdefault(file, (seek, header))
+
+  def flush(self):
+    # one flush is queued at a time, it writes every checkpoint made so far.
+    with self.lock:
+      if self.flush_pending or not self.checkpoints:
+        return
+      self.flush_pending = True
+    self.execute(self.write_checkpoints, sync=False)
+
+  def write_checkpoints(self, conn):
+    with self.lock:
+      checkpoints, self.checkpoints = self.checkpoints, {}
+      self.flush_pending = False
+    if not checkpoints:
+      return
+    conn.executemany("insert or replace into file_stat (file, seek, header) values (?, ?, ?)",
+                     [(file, seek, header) for file, (seek, header) in iter_items(checkpoints)])
 
   def execute(self, f, sync=True):
-    func = f
+    # functions run in the transaction of a batch and must not commit,
+    # sync=False returns a DBFuture.
+    future = DBFuture()
+    self.queue.put((f, future))
     if sync:
-      q = queue.Queue()
-      def func(conn):
-        result = None
+      future.event.wait()
+      return future.value
+    return future
+
+  def stats(self):
+    with self.lock:
+      durations = dict(self.durations)
+    durations["avg"] = durations["total"] / durations["count"] if durations["count"] else 0.0
+    durations["queue_depth"] = self.queue.qsize()
+    return durations
+
+  def connect(self):
+    if not os.path.exists(self.__class__.db_file):
+      LOGGER.info("Create new db: {}.".format(self.__class__.db_file))
+    # transactions are managed by the batches.
+    conn = sqlite3.connect(self.__class__.db_file, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    self.migrate(conn)
+    return conn
+
+  def migrate(self, conn):
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    for i in irange(version, len(DBThread.MIGRATIONS)):
+      LOGGER.info("Migrate db to version {}.".format(i + 1))
+      conn.execute("BEGIN")
+      try:
+        for statement in DBThread.MIGRATIONS[i]:
+          conn.execute(statement)
+        conn.execute("PRAGMA user_version = {:d}".format(i + 1))
+        conn.execute("COMMIT")
+      except:
+        conn.execute("ROLLBACK")
+        raise
+
+  def run_batch(self, items):
+    # items share one transaction, a savepoint rolls back a failed item only.
+    started_at = time.time()
+    results = []
+    try:
+      self.conn.execute("BEGIN")
+      for f, future in items:
+        self.conn.execute("SAVEPOINT item")
         try:
-          result = f(conn)
-        finally:
-          q.put(result)
-    self.queue.put(func)
-    if sync:
-      return q.get()
-    
+          results.append((future, f(self.conn), None))
+          self.conn.execute("RELEASE item")
+        except Exception as e:
+          LOGGER.error("Error in DBThread: {}".format(u_(e)))
+          self.conn.execute("ROLLBACK TO item")
+          self.conn.execute("RELEASE item")
+          results.append((future, None, e))
+      self.conn.execute("COMMIT")
+    except Exception as e:
+      LOGGER.error("Error in DBThread: {}".format(u_(e)))
+      try:
+        self.conn.execute("ROLLBACK")
+      except sqlite3.Error:
+        pass
+      results = [(future, None, e) for f, future in items]
+    duration = time.time() - started_at
+    with self.lock:
+      self.durations["count"] += 1
+      self.durations["items"] += len(items)
+      self.durations["total"] += duration
+      self.durations["max"] = max(self.durations["max"], duration)
+      self.durations["last"] = duration
+    for future, value, error in results:
+      future.set_result(value, error)
+
   def run(self):
     LOGGER.info("DB file: {}.".format(self.__class__.db_file))
-    if not os.path.exists(self.__class__.db_file):
-      LOGGER.info("Create new db: {}.".format(self.__class__.db_file))
-      conn = sqlite3.connect(self.__class__.db_file)
-      cur = conn.cursor()
-      cur.execute('''create table file_stat (file text, seek int, header text)''')
-      conn.commit()
-      conn.close()
-    self.conn = sqlite3.connect(self.__class__.db_file)
+    try:
+      self.conn = self.connect()
+      self.load_checkpoints(self.conn)
+    finally:
+      self.loaded.set()
 
     while True:
-      try:
-        next_item = self.queue.get()
-        if next_item is STOP_THREAD: 
-          self.conn.close()
-          self.queue.task_done()
+      items = [self.queue.get()]
+      while items[-1] is not STOP_THREAD and len(items) < DBThread.MAX_BATCH:
+        try:
+          items.append(self.queue.get_nowait())
+        except queue.Empty:
           break
-        next_item(self.conn)
+      stopping = items[-1] is STOP_THREAD
+      if stopping:
+        items[-1] = (self.write_checkpoints, DBFuture())
+      self.run_batch(items)
+      for item in items:
         self.queue.task_done()
-      except queue.Empty:
-        pass
-      except Exception as e:
-        LOGGER.error("Error in DBThread: {}".format(u_(e)))
+      if stopping:
+        self.conn.close()
+        break
+# }}}
+
+class TimeSeriesStore(object): # {{{
+  ROLLUPS = ((60, "rollup_1m"), (300, "rollup_5m"), (3600, "rollup_1h"))
+  DEFAULT_RETENTION = {
+    "samples_raw": 7*86400,
+    "rollup_1m":   30*86400,
+    "rollup_5m":   180*86400,
+    "rollup_1h":   3*365*86400
+  }
+  PRUNE_INTERVAL = 3600
+
+  def __init__(self, db_thread, retention={}):
+    self.db_thread = db_thread
+    self.retention = with_defaults(TimeSeriesStore.DEFAULT_RETENTION, retention)
+    self.lock = threading.Lock()
+    self.samples = []
+    # (secs, name, start of the bucket) => [min, max, sum, count]
+    self.buckets = {}
+    self.flush_pending = False
+    self.pruned_at = 0
+    # variable ids, used only on the db thread.
+    self.ids = {}
+
+  def append(self, name, value, t=None):
+    t = t or time.time()
+    with self.lock:
+      self.samples.append((name, t, value))
+      for seconds, _ in TimeSeriesStore.ROLLUPS:
+        key = (seconds, name, int(t // seconds) * seconds)
+        bucket = self.buckets.get(key)
+        if bucket is None:
+          self.buckets[key] = [value, value, value, 1]
+        else:
+          bucket[0] = min(bucket[0], value)
+          bucket[1] = max(bucket[1], value)
+          bucket[2] += value
+          bucket[3] += 1
+
+  def flush(self, force=False):
+    # raw samples and finished buckets are written, force writes all buckets.
+    with self.lock:
+      if not force and (self.flush_pending or not (self.samples or self.buckets)):
+        return
+      self.flush_pending = True
+    self.db_thread.execute(lambda conn: self.write(conn, force), sync=False)
+
+  def write(self, conn, force=False):
+    now = time.time()
+    with self.lock:
+      samples, self.samples = self.samples, []
+      buckets = {}
+      for key in list(self.buckets):
+        if force or key[2] + key[0] <= now:
+          buckets[key] = self.buckets.pop(key)
+      self.flush_pending = False
+    conn.executemany("insert into samples_raw (var, t, value) values (?, ?, ?)",
+                     [(self.var_id(conn, name), t, value) for name, t, value in samples])
+    tables = dict(TimeSeriesStore.ROLLUPS)
+    for (seconds, name, t), bucket in iter_items(buckets):
+      var = self.var_id(conn, name)
+      # merges a bucket written before a restart.
+      row = conn.execute("select min, max, sum, count from {} where var = ? and t = ?".format(tables[seconds]), (var, t)).fetchone()
+      if row is not None:
+        bucket = [min(bucket[0], row[0]), max(bucket[1], row[1]), bucket[2] + row[2], bucket[3] + row[3]]
+      conn.execute("insert or replace into {} (var, t, min, max, sum, count) values (?, ?, ?, ?, ?, ?)".format(tables[seconds]),
+                   [var, t] + bucket)
+    if now - self.pruned_at >= TimeSeriesStore.PRUNE_INTERVAL:
+      self.prune(conn, now)
+
+  def var_id(self, conn, name):
+    id = self.ids.get(name)
+    if id is None:
+      conn.execute("insert or ignore into vars (name) values (?)", (name,))
+      id = self.ids[name] = conn.execute("select id from vars where name = ?", (name,)).fetchone()[0]
+    return id
+
+  def prune(self, conn, now):
+    self.pruned_at = now
+    for table in ["samples_raw"] + [v for _, v in TimeSeriesStore.ROLLUPS]:
+      if self.retention.get(table) is not None:
+        conn.execute("delete from {} where t < ?".format(table), (now - self.retention[table],))
+
+  def query(self, name, start, end, resolution=0):
+    # returns [(t, value)] of raw samples, or [(t, min, max, avg)] of
+    # rollups of resolution(60, 300 or 3600) secs.
+    tables = dict(TimeSeriesStore.ROLLUPS)
+    if resolution and resolution not in tables:
+      raise ValueError("Invalid resolution: {}".format(resolution))
+    self.flush()
+    def f(conn):
+      row = conn.execute("select id from vars where name = ?", (name,)).fetchone()
+      if not resolution:
+        if row is None:
+          return []
+        return conn.execute("select t, value from samples_raw where var = ? and t >= ? and t < ? order by t",
+                            (row[0], start, end)).fetchall()
+      buckets = {}
+      if row is not None:
+        for t, lo, hi, total, count in conn.execute(
+            "select t, min, max, sum, count from {} where var = ? and t >= ? and t < ?".format(tables[resolution]),
+            (row[0], int(start // resolution) * resolution, end)):
+          buckets[t] = [lo, hi, total, count]
+      # buckets not written yet.
+      with self.lock:
+        for (seconds, var, t), bucket in iter_items(self.buckets):
+          if seconds != resolution or var != name or t >= end or t + seconds <= start:
+            continue
+          if t in buckets:
+            saved = buckets[t]
+            bucket = [min(bucket[0], saved[0]), max(bucket[1], saved[1]), bucket[2] + saved[2], bucket[3] + saved[3]]
+          buckets[t] = bucket
+      return [(t, v[0], v[1], float(v[2]) / v[3]) for t, v in sorted(iter_items(buckets))]
+    return self.db_thread.execute(f)
 # }}}
 
 class Target(object): # {{{
@@ -197,11 +742,58 @@ class Target(object): # {{{
     pre_state = self["__state__"]
     if pre_state == state and check_state:
       return
+    # a dropped transition keeps the previous state to be sent again.
+    if self["rate_limit"] is not None:
+      if self["__bucket__"] is None:
+        self["__bucket__"] = TokenBucket(self["rate_limit"], self["burst"])
+      if not self["__bucket__"].consume():
+        return
+      self["__dropped__"] = self["__bucket__"].take_dropped()
     self["__state__"] = state
     message = u_("[")+ u_(self.monitor_name) + u_("] ") + u_(self.monitor.attrs["messages"][state]).format(**self.attrs)
     self.monitor.callback(level, message, self)
 # }}}
 
+class TokenBucket(object): # {{{
+  def __init__(self, rate, burst=None):
+    self.rate = float(rate)
+    self.burst = float(burst or max(self.rate, 1))
+    self.tokens = self.burst
+    self.updated_at = time.time()
+    self.dropped = 0
+    self.lock = threading.Lock()
+
+  def consume(self):
+    with self.lock:
+      now = time.time()
+      self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+      self.updated_at = now
+      if self.tokens < 1:
+        self.dropped += 1
+        return False
+      self.tokens -= 1
+      return True
+
+  def take_dropped(self):
+    with self.lock:
+      dropped, self.dropped = self.dropped, 0
+      return dropped
+# }}}
+
+class RateLimited(object): # {{{
+  def __init__(self, callback, rate, burst=None):
+    self.callback = callback
+    self.bucket = TokenBucket(rate, burst)
+
+  def __call__(self, level, message, target):
+    if not self.bucket.consume():
+      return
+    dropped = self.bucket.take_dropped()
+    if dropped:
+      message = u_("{} ({} events were suppressed)").format(message, dropped)
+    self.callback(level, message, target)
+# }}}
+
 class Monitor(BaseThread): # {{{
   DEFAULT_ATTRS = {
       "interval": 300,
@@ -213,6 +805,7 @@ class Monitor(BaseThread): # {{{
 
   def __init__(self, attrs):
     BaseThread.__init__(self)
+    self.wakeup_pending = False
     self.attrs = with_defaults(self.default_attrs(), attrs, copy=False)
     self.init_attrs()
 
@@ -231,74 +824,1067 @@ class Monitor(BaseThread): # {{{
 
   def monitor(self): raise NotImplementedError()
 
+  def deadline(self):
+    # the time the monitor has to tick before the next interval, or None.
+    return None
+
+  def next_tick(self, started_at):
+    at = started_at + self.attrs["interval"]
+    deadline = self.deadline()
+    return at if deadline is None else min(at, deadline)
+
+  def async_monitor(self, loop, executor):
+    return loop.run_in_executor(executor, self.monitor)
+
+  def wakeup(self):
+    KERNEL.wakeup(self)
+
+  def tick(self):
+    self.wakeup_pending = False
+    try:
+      self.monitor()
+    except Exception as e:
+      import traceback
+      traceback.print_exc()
+      LOGGER.error("Error in {}: {}".format(self.__class__.__name__, u_(e)))
+
+  def stop(self):
+    # monitors driven by a Scheduler are never started as threads.
+    if self.is_alive():
+      BaseThread.stop(self)
+
   def run(self):
     time.sleep(KERNEL.attrs["waiting_time_on_boot"])
     while True:
       started_at = time.time()
+      self.tick()
       try:
-        self.monitor()
-        t = time.time() - started_at
-        next_item = self.queue.get(timeout=self.attrs["interval"] - t)
+        next_item = self.queue.get(timeout=max(self.next_tick(started_at) - time.time(), 0))
         if next_item is STOP_THREAD: 
           self.queue.task_done()
           break
         self.queue.task_done()
       except queue.Empty:
         pass
-      except Exception as e:
-        import traceback
-        traceback.print_exc()
-        LOGGER.error("Error in {}: {}".format(self.__class__.__name__, u_(e)))
 
 # }}}
 
+class SchedulerWorker(BaseThread): # {{{
+  def __init__(self, scheduler):
+    BaseThread.__init__(self)
+    self.scheduler = scheduler
+    self.queue = scheduler.jobs
+
+  def run(self):
+    while True:
+      monitor = self.queue.get()
+      if monitor is STOP_THREAD:
+        self.queue.task_done()
+        break
+      started_at = time.time()
+      monitor.tick()
+      self.scheduler.done(monitor, started_at)
+      self.queue.task_done()
+# }}}
+
+class Scheduler(BaseThread): # {{{
+  def __init__(self, workers=4):
+    BaseThread.__init__(self)
+    self.heap = []
+    self.seq = 0
+    self.entries = {}
+    self.running = set()
+    self.pending = set()
+    self.jobs = queue.Queue()
+    self.workers = [SchedulerWorker(self) for i in irange(workers)]
+
+  def schedule(self, monitor, at=None):
+    self.queue.put(("schedule", monitor, at or time.time()))
+
+  def wakeup(self, monitor):
+    self.queue.put(("wakeup", monitor, None))
+
+  def done(self, monitor, started_at):
+    self.queue.put(("done", monitor, monitor.next_tick(started_at)))
+
+  def start(self):
+    for worker in self.workers:
+      worker.start()
+    BaseThread.start(self)
+
+  def stop(self):
+    # workers may still report finished jobs after the STOP_THREAD, so
+    # wait for the threads instead of joining the queues.
+    self.queue.put(STOP_THREAD)
+    self.join()
+    for worker in self.workers:
+      self.jobs.put(STOP_THREAD)
+    for worker in self.workers:
+      worker.join()
+
+  def push(self, monitor, at):
+    self.seq += 1
+    self.entries[monitor] = self.seq
+    heapq.heappush(self.heap, (at, self.seq, monitor))
+
+  def dispatch(self):
+    now = time.time()
+    while self.heap and self.heap[0][0] <= now:
+      at, seq, monitor = heapq.heappop(self.heap)
+      if self.entries.get(monitor) != seq:
+        continue
+      del self.entries[monitor]
+      self.running.add(monitor)
+      self.jobs.put(monitor)
+
+  def run(self):
+    while True:
+      timeout = None
+      if self.heap:
+        timeout = max(self.heap[0][0] - time.time(), 0)
+      try:
+        next_item = self.queue.get(timeout=timeout)
+        if next_item is STOP_THREAD:
+          self.queue.task_done()
+          break
+        command, monitor, at = next_item
+        if command == "schedule":
+          self.push(monitor, at)
+        elif command == "done":
+          self.running.discard(monitor)
+          if monitor in self.pending:
+            self.pending.discard(monitor)
+            at = time.time()
+          self.push(monitor, at)
+        elif command == "wakeup":
+          if monitor in self.entries:
+            self.push(monitor, time.time())
+          elif monitor in self.running:
+            self.pending.add(monitor)
+        self.queue.task_done()
+      except queue.Empty:
+        pass
+      self.dispatch()
+# }}}
+
+class Inotify(object): # {{{
+  IN_MODIFY      = 0x00000002
+  IN_ATTRIB      = 0x00000004
+  IN_MOVED_TO    = 0x00000080
+  IN_CREATE      = 0x00000100
+  IN_DELETE_SELF = 0x00000400
+  IN_MOVE_SELF   = 0x00000800
+  IN_Q_OVERFLOW  = 0x00004000
+  IN_IGNORED     = 0x00008000
+  IN_MASK_ADD    = 0x20000000
+  IN_NONBLOCK    = 0x00000800
+  IN_CLOEXEC     = 0x00080000
+  FILE_MASK = IN_MODIFY | IN_ATTRIB | IN_MOVE_SELF | IN_DELETE_SELF
+  DIR_MASK = IN_CREATE | IN_MOVED_TO
+  EVENT = struct.Struct("iIII")
+  libc = None
+
+  @classmethod
+  def load(cls):
+    if cls.libc is None:
+      cls.libc = False
+      if ctypes is not None and sys.platform.startswith("linux"):
+        try:
+          libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+          libc.inotify_init1, libc.inotify_add_watch, libc.inotify_rm_watch
+          cls.libc = libc
+        except (OSError, AttributeError):
+          pass
+    return cls.libc or None
+
+  def __init__(self):
+    self.libc = Inotify.load()
+    if self.libc is None:
+      raise OSError(errno.ENOSYS, "inotify is not available")
+    self.fd = self.libc.inotify_init1(Inotify.IN_NONBLOCK | Inotify.IN_CLOEXEC)
+    if self.fd < 0:
+      raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+    # wd => {key: (name in the directory or None, callback)}
+    self.watches = {}
+    self.keys = {}
+
+  def close(self):
+    os.close(self.fd)
+
+  def encode(self, path):
+    return path if isinstance(path, bytes) else path.encode(sys.getfilesystemencoding() or "utf8")
+
+  def add(self, key, path, callback):
+    # watches a file and its directory for files created at the path, or
+    # a directory for files created or changed in it.
+    self.remove(key)
+    path = os.path.abspath(path)
+    if os.path.isdir(path):
+      watches = ((path, Inotify.DIR_MASK | Inotify.IN_MODIFY | Inotify.IN_ATTRIB, None),)
+    else:
+      directory, name = os.path.split(path)
+      watches = ((path, Inotify.FILE_MASK, None),
+                 (directory, Inotify.DIR_MASK, self.encode(name)))
+    wds = []
+    for target, mask, filename in watches:
+      wd = self.libc.inotify_add_watch(self.fd, self.encode(target), mask | Inotify.IN_MASK_ADD)
+      if wd >= 0:
+        self.watches.setdefault(wd, {})[key] = (filename, callback)
+        wds.append(wd)
+    self.keys[key] = wds
+    return bool(wds)
+
+  def remove(self, key):
+    for wd in self.keys.pop(key, []):
+      entries = self.watches.get(wd, {})
+      entries.pop(key, None)
+      if not entries and self.watches.pop(wd, None) is not None:
+        self.libc.inotify_rm_watch(self.fd, wd)
+
+  def read(self):
+    try:
+      data = os.read(self.fd, 65536)
+    except OSError as e:
+      if e.errno == errno.EAGAIN:
+        return
+      raise
+    callbacks = {}
+    pos = 0
+    while pos + Inotify.EVENT.size <= len(data):
+      wd, mask, cookie, length = Inotify.EVENT.unpack_from(data, pos)
+      pos += Inotify.EVENT.size
+      name = data[pos:pos + length].rstrip(b_("\0"))
+      pos += length
+      if mask & Inotify.IN_Q_OVERFLOW:
+        for entries in iter_values(self.watches):
+          callbacks.update((key, v[1]) for key, v in iter_items(entries))
+      for key, (filename, callback) in iter_items(self.watches.get(wd, {})):
+        if filename is None or filename == name:
+          callbacks[key] = callback
+      if mask & Inotify.IN_IGNORED:
+        # the watched file has gone and the wd may be reused.
+        for key in self.watches.pop(wd, {}):
+          self.keys[key].remove(wd)
+    for callback in iter_values(callbacks):
+      callback()
+# }}}
+
+class Watcher(BaseThread): # {{{
+  def __init__(self, interval=1):
+    BaseThread.__init__(self)
+    self.interval = interval
+    self.poller = select.poll()
+    self.pipe = os.pipe()
+    self.poller.register(self.pipe[0], select.POLLIN)
+    self.fds = {}
+    self.pids = {}
+    self.inotify = None
+
+  def execute(self, f):
+    self.queue.put(f)
+    os.write(self.pipe[1], b_("."))
+
+  def stop(self):
+    self.execute(STOP_THREAD)
+    self.queue.join()
+
+  # following methods must be called in the watcher thread.
+  def watch_fd(self, fd, callback):
+    self.fds[fd] = callback
+    self.poller.register(fd, select.POLLIN)
+
+  def unwatch_fd(self, fd):
+    if self.fds.pop(fd, None) is not None:
+      self.poller.unregister(fd)
+
+  def add_pid(self, key, pid, callback):
+    self.remove_pid(key)
+    fd = None
+    if hasattr(os, "pidfd_open"):
+      try:
+        fd = os.pidfd_open(pid)
+      except OSError as e:
+        if e.errno == errno.ESRCH:
+          return callback(pid)
+        # e.g. ENOSYS on kernels without pidfd or EMFILE, /proc is polled.
+        LOGGER.info("pidfd is not available for {}, /proc is polled: {}".format(pid, u_(e)))
+      if fd is not None:
+        self.watch_fd(fd, lambda fd: self.exited(key))
+    self.pids[key] = (pid, fd, callback)
+
+  def remove_pid(self, key):
+    pid, fd, callback = self.pids.pop(key, (None, None, None))
+    if fd is not None:
+      self.unwatch_fd(fd)
+      os.close(fd)
+    return callback
+
+  def exited(self, key):
+    pid = self.pids[key][0]
+    self.remove_pid(key)(pid)
+
+  def add_path(self, key, path, callback):
+    if self.inotify is None:
+      try:
+        self.inotify = Inotify()
+        self.watch_fd(self.inotify.fd, lambda fd: self.inotify.read())
+      except OSError as e:
+        LOGGER.info("inotify is not available, files are polled: {}".format(u_(e)))
+        self.inotify = False
+    if self.inotify:
+      self.inotify.add(key, path, callback)
+
+  def remove_path(self, key):
+    if self.inotify:
+      self.inotify.remove(key)
+
+  def watch_path(self, key, path, callback):
+    self.execute(lambda: self.add_path(key, path, callback))
+
+  def unwatch_path(self, key):
+    self.execute(lambda: self.remove_path(key))
+
+  def watch_pid(self, key, pid, callback):
+    self.execute(lambda: self.add_pid(key, pid, callback))
+
+  def unwatch_pid(self, key):
+    self.execute(lambda: self.remove_pid(key))
+
+  def run(self):
+    while True:
+      timeout = None
+      if any(v[1] is None for v in iter_values(self.pids)):
+        timeout = self.interval * 1000
+      try:
+        events = self.poller.poll(timeout)
+      except (select.error, IOError, OSError):
+        events = []
+      for fd, event in events:
+        if fd == self.pipe[0]:
+          os.read(fd, 4096)
+        elif fd in self.fds:
+          try:
+            self.fds[fd](fd)
+          except Exception as e:
+            LOGGER.error("Error in Watcher: {}".format(u_(e)))
+
+      next_item = None
+      while next_item is not STOP_THREAD:
+        try:
+          next_item = self.queue.get_nowait()
+        except queue.Empty:
+          break
+        try:
+          if next_item is not STOP_THREAD:
+            next_item()
+        except Exception as e:
+          LOGGER.error("Error in Watcher: {}".format(u_(e)))
+        self.queue.task_done()
+      if next_item is STOP_THREAD:
+        for key in list(self.pids):
+          self.remove_pid(key)
+        if self.inotify:
+          self.inotify.close()
+        os.close(self.pipe[0])
+        os.close(self.pipe[1])
+        break
+
+      # processes without a pidfd are polled.
+      for key, v in list(iter_items(self.pids)):
+        if v[1] is None and not os.path.exists("/proc/{}".format(v[0])):
+          self.exited(key)
+# }}}
+
+class PatternSet(object): # {{{
+  MIN_LITERAL_LENGTH = 2
+
+  def __init__(self, patterns, method="search"):
+    self.patterns = [re.compile(v) if isinstance(v, string_types) else v for v in patterns]
+    self.methods = [getattr(v, method) for v in self.patterns]
+    self.always = []
+    literals = {}
+    for i, pattern in enumerate(self.patterns):
+      literal = PatternSet.required_literal(pattern)
+      if literal is None:
+        self.always.append(i)
+      else:
+        literals.setdefault(literal, []).append(i)
+    # a literal found in a line implies every literal contained in it.
+    self.candidates = {}
+    for literal in literals:
+      self.candidates[literal] = sorted(i for other, indices in iter_items(literals) 
+                                          if other in literal for i in indices)
+    self.prefilter = None
+    if literals:
+      # a lookahead finds every position where a literal starts, and
+      # the longest literal wins at each position.
+      alternatives = sorted(literals, key=len, reverse=True)
+      self.prefilter = re.compile(u_("(?=(") + u_("|").join(re.escape(v) for v in alternatives) + u_("))"))
+    # patterns without literals are tried only if their union matches.
+    self.any_always = None
+    if len(self.always) > 1:
+      combined = PatternSet.combine([self.patterns[i] for i in self.always])
+      if combined is not None:
+        self.any_always = getattr(combined, method)
+
+  @classmethod
+  def combine(cls, patterns):
+    flags = patterns[0].flags
+    for pattern in patterns:
+      if (PY3 and isinstance(pattern.pattern, bytes)) or pattern.flags != flags:
+        return None
+      # inline flags would apply to the whole union.
+      if re.search("\\(\\?[aiLmsux]+\\)", pattern.pattern):
+        return None
+      try:
+        if cls.has_groupref(sre_parse.parse(pattern.pattern, pattern.flags)):
+          return None
+      except Exception:
+        return None
+    try:
+      return re.compile(u_("|").join(u_("(?:{})").format(v.pattern) for v in patterns), flags)
+    except Exception:
+      return None
+
+  @classmethod
+  def has_groupref(cls, items):
+    # group numbers change in the union.
+    for op, av in items:
+      if str(op).upper().startswith("GROUPREF"):
+        return True
+      for v in (av if isinstance(av, (list, tuple)) else [av]):
+        for sub in (v if isinstance(v, (list, tuple)) else [v]):
+          if isinstance(sub, sre_parse.SubPattern) and cls.has_groupref(sub):
+            return True
+    return False
+
+  @classmethod
+  def required_literal(cls, pattern):
+    if pattern.flags & re.IGNORECASE:
+      return None
+    if isinstance(pattern.pattern, bytes) and (PY3 or re.search(r"[\x80-\xff]", pattern.pattern)):
+      return None
+    try:
+      parsed = sre_parse.parse(pattern.pattern, pattern.flags)
+    except Exception:
+      return None
+    runs = [[]]
+    def walk(items):
+      for op, av in items:
+        name = str(op).upper()
+        if name == "LITERAL":
+          runs[-1].append(av)
+        elif name == "SUBPATTERN" and not (len(av) > 2 and av[1] & re.IGNORECASE):
+          walk(av[-1])
+        elif name != "AT":
+          runs.append([])
+    walk(parsed)
+    longest = max(runs, key=len)
+    if len(longest) < cls.MIN_LITERAL_LENGTH:
+      return None
+    return u_("").join(unichr(v) for v in longest)
+
+  def bytes_prefilter(self, encoding):
+    # finds lines that may match without decoding them. the literals must
+    # be encoded to the same bytes wherever they appear in a line.
+    if self.always or not self.candidates:
+      return None
+    utf8 = codecs.lookup(encoding).name == "utf-8"
+    alternatives = []
+    for literal in sorted(self.candidates, key=len, reverse=True):
+      encoded = literal.encode(encoding)
+      if not utf8 and (re.search(u_("[^\x00-\x7f]"), literal) or encoded != literal.encode("ascii")):
+        return None
+      alternatives.append(re.escape(encoded))
+    return re.compile(b_("|").join(alternatives))
+
+  def match_indices(self, line):
+    always = self.always
+    if self.any_always is not None and not self.any_always(line):
+      always = []
+    if self.prefilter is None:
+      return always
+    found = set(m.group(1) for m in self.prefilter.finditer(line))
+    if not found:
+      return always
+    indices = set(always)
+    for literal in found:
+      indices.update(self.candidates[literal])
+    return sorted(indices)
+
+  def matches(self, line):
+    result = []
+    for i in self.match_indices(line):
+      m = self.methods[i](line)
+      if m:
+        result.append((i, m))
+    return result
+
+  def collect(self, lines):
+    matches = [[] for v in self.patterns]
+    for n, line in enumerate(lines):
+      for i in self.match_indices(line):
+        if self.methods[i](line):
+          matches[i].append(n)
+    return matches
+
+  def counts(self, lines):
+    return [len(v) for v in self.collect(lines)]
+# }}}
+
+class ProcessInfo(object): # {{{
+  __slots__ = ("pid", "ppid", "uid", "comm", "cmdline", "tty", "start_time", "cpu_time",
+               "cpu_ticks", "cpu_percent", "rss", "threads", "_line")
+
+  CLK_TCK = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+  PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+  BOOT_TIME = None
+  USERS = {}
+  MONTHS = ["Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep", "Oct", "Nov", "Dec"]
+
+  def __init__(self, pid, ppid, uid, comm, cmdline, tty, start_time, cpu_ticks, rss, threads):
+    self.pid = pid
+    self.ppid = ppid
+    self.uid = uid
+    self.comm = comm
+    self.cmdline = cmdline
+    self.tty = tty
+    self.start_time = start_time
+    self.cpu_ticks = cpu_ticks
+    self.cpu_time = cpu_ticks // ProcessInfo.CLK_TCK
+    self.cpu_percent = None
+    self.rss = rss
+    self.threads = threads
+    self._line = None
+
+  @classmethod
+  def boot_time(cls, proc_dir="/proc"):
+    if cls.BOOT_TIME is None:
+      with open(os.path.join(proc_dir, "stat"), "rb") as io:
+        for line in io:
+          if line.startswith(b_("btime")):
+            cls.BOOT_TIME = int(line.split()[1])
+    return cls.BOOT_TIME
+
+  @classmethod
+  def user_name(cls, uid):
+    if uid not in cls.USERS:
+      try:
+        name = u_(pwd.getpwuid(uid).pw_name)
+      except (KeyError, AttributeError):
+        name = u_(uid)
+      cls.USERS[uid] = name if len(name) <= 8 else name[:7] + u_("+")
+    return cls.USERS[uid]
+
+  @classmethod
+  def read(cls, pid, proc_dir="/proc"):
+    path = os.path.join(proc_dir, u_(pid))
+    uid = os.stat(path).st_uid
+    with open(os.path.join(path, "stat"), "rb") as io:
+      stat = io.read()
+    with open(os.path.join(path, "cmdline"), "rb") as io:
+      cmdline = io.read()
+    # comm may contain spaces and parentheses.
+    comm = u_(stat[stat.index(b_("("))+1:stat.rindex(b_(")"))], errors="replace")
+    fields = stat[stat.rindex(b_(")"))+2:].split()
+    cmdline = u_(cmdline.replace(b_("\0"), b_(" ")).strip(), errors="replace")
+    return cls(pid, int(fields[1]), uid, comm, cmdline, int(fields[4]),
+               cls.boot_time(proc_dir) + float(fields[19]) / cls.CLK_TCK,
+               int(fields[11]) + int(fields[12]), int(fields[21]) * cls.PAGE_SIZE // 1024,
+               int(fields[17]))
+
+  @classmethod
+  def read_all(cls, proc_dir="/proc"):
+    processes = []
+    for name in os.listdir(proc_dir):
+      if not name.isdigit():
+        continue
+      try:
+        processes.append(cls.read(int(name), proc_dir))
+      except (IOError, OSError, ValueError, IndexError):
+        # the process has exited while reading.
+        pass
+    return processes
+
+  @property
+  def user(self):
+    return ProcessInfo.user_name(self.uid)
+
+  def open_fds(self, proc_dir="/proc"):
+    try:
+      return len(os.listdir(os.path.join(proc_dir, u_(self.pid), "fd")))
+    except OSError:
+      return 0
+
+  def tty_name(self):
+    major = (self.tty >> 8) & 0xfff
+    minor = (self.tty & 0xff) | ((self.tty >> 12) & 0xfff00)
+    if 136 <= major <= 143:
+      return "pts/{}".format((major - 136) * 256 + minor)
+    if major == 4:
+      return "tty{}".format(minor) if minor < 64 else "ttyS{}".format(minor - 64)
+    return "?"
+
+  def as_ps_line(self):
+    if self._line is None:
+      now = time.time()
+      started = time.localtime(self.start_time)
+      if time.localtime(now)[:3] == started[:3]:
+        stime = "{:02d}:{:02d}".format(started.tm_hour, started.tm_min)
+      elif started.tm_year == time.localtime(now).tm_year:
+        stime = "{}{:02d}".format(ProcessInfo.MONTHS[started.tm_mon-1], started.tm_mday)
+      else:
+        stime = "{}".format(started.tm_year)
+      elapsed = max(now - self.start_time, 1)
+      c = min(int(self.cpu_time * 100 / elapsed), 99)
+      days, rest = divmod(self.cpu_time, 86400)
+      cputime = "{:02d}:{:02d}:{:02d}".format(rest // 3600, rest % 3600 // 60, rest % 60)
+      if days:
+        cputime = "{}-{}".format(days, cputime)
+      self._line = u_("{:<8s} {:>7d} {:>7d} {:>2d} {:<5s} {:<8s} {:>8s} {}").format(
+        self.user, self.pid, self.ppid, c, stime, self.tty_name(), cputime,
+        self.cmdline or u_("[{}]").format(self.comm))
+    return self._line
+# }}}
+
+class ProcessTable(object): # {{{
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.snapshots = {}
+    self.cpu_ticks = {}
+    # futures of ps runs in flight per source.
+    self.pending = {}
+    self.hits = 0
+    self.misses = 0
+
+  def load(self, source):
+    if source == "proc":
+      return self.update_cpu_percent(ProcessInfo.read_all())
+    return u_(p_out(["ps", "-ef"]), errors="replace").splitlines()
+
+  def update_cpu_percent(self, processes):
+    # keeps (start time, cpu ticks, scanned at) of live pids only.
+    now = time.time()
+    cpu_ticks = {}
+    for process in processes:
+      last = self.cpu_ticks.get(process.pid)
+      if last is not None and last[0] == process.start_time and now > last[2]:
+        process.cpu_percent = (process.cpu_ticks - last[1]) * 100.0 / ProcessInfo.CLK_TCK / (now - last[2])
+      cpu_ticks[process.pid] = (process.start_time, process.cpu_ticks, now)
+    self.cpu_ticks = cpu_ticks
+    return processes
+
+  def cached(self, source, ttl):
+    snapshot = self.snapshots.get(source)
+    if snapshot is not None and time.time() - snapshot[0] < ttl:
+      self.hits += 1
+      return snapshot[1]
+    return None
+
+  def update(self, source, processes):
+    self.misses += 1
+    self.snapshots[source] = (time.time(), processes)
+    return processes
+
+  def snapshot(self, source="proc", ttl=1):
+    # monitors that arrive while a scan is running wait for its result.
+    with self.lock:
+      processes = self.cached(source, ttl)
+      if processes is None:
+        processes = self.update(source, self.load(source))
+      return processes
+
+  def async_snapshot(self, source, ttl, loop):
+    # returns a future of the snapshot, monitors that arrive while ps is
+    # running share its future.
+    with self.lock:
+      processes = self.cached(source, ttl)
+      if processes is None:
+        future = self.pending.get(source)
+        if future is not None:
+          self.hits += 1
+          return future
+      else:
+        future = loop.create_future()
+        future.set_result(processes)
+        return future
+      def update(out):
+        with self.lock:
+          return self.update(source, u_(out, errors="replace").splitlines())
+      def done(f):
+        with self.lock:
+          if self.pending.get(source) is f:
+            del self.pending[source]
+      future = self.pending[source] = future_then(async_p_out(["ps", "-ef"], loop), update, loop)
+      future.add_done_callback(done)
+      return future
+
+  def stats(self):
+    with self.lock:
+      return {"hits": self.hits, "misses": self.misses}
+
+PROCESS_TABLE = ProcessTable()
+# }}}
+
 class ProcessMonitor(Monitor): # {{{
   def default_attrs(self):
     attrs = Monitor.default_attrs(self)
+    attrs["snapshot_ttl"] = 1
     attrs["messages"]["min"] = "{name}: {__count__:d} process(< {min:d})."
     attrs["messages"]["max"] = "{name}: {__count__:d} process(> {max:d})."
+    attrs["messages"]["rss"] = "{name}: RSS {__rss__:d}KB(> {max_rss:d}KB)."
+    attrs["messages"]["cpu"] = "{name}: CPU {__cpu__:.1f}%(> {max_cpu}%)."
+    attrs["messages"]["fds"] = "{name}: {__fds__:d} open files(> {max_fds:d})."
+    attrs["messages"]["threads"] = "{name}: {__threads__:d} threads(> {max_threads:d})."
     attrs["messages"]["normal"] = "{name}: Resume normal operations."
     return attrs
 
   def init_attrs(self):
     Monitor.init_attrs(self)
+    if "source" not in self.attrs:
+      self.attrs["source"] = "proc" if os.path.exists("/proc/self/stat") else "ps"
+    patterns = []
     for target in self.attrs["targets"]:
-      target["__pattern__"] = re.compile(target["pattern"])
+      if target["pattern"] not in patterns:
+        patterns.append(target["pattern"])
+      target["__index__"] = patterns.index(target["pattern"])
       target["__count__"] = 0
+    self.pattern_set = PatternSet(patterns)
+    for target in self.attrs["targets"]:
+      target["__pattern__"] = self.pattern_set.patterns[target["__index__"]]
+      if target["critical"] and self.attrs["source"] == "ps":
+        LOGGER.warning("{}: critical targets are not watched with the ps source.".format(target["name"]))
+    self.watched_pids = set()
+    self.refresh = False
 
   def get_process_list(self):
-    return p_out(["ps", "-ef"]).splitlines()
+    ttl = self.attrs["snapshot_ttl"]
+    if self.refresh:
+      # a watched process has exited, the snapshot is outdated.
+      self.refresh = False
+      ttl = 0
+    return PROCESS_TABLE.snapshot(self.attrs["source"], ttl)
+
+  def async_monitor(self, loop, executor):
+    if type(self).get_process_list is not ProcessMonitor.get_process_list or self.attrs["source"] != "ps":
+      return Monitor.async_monitor(self, loop, executor)
+    future = PROCESS_TABLE.async_snapshot("ps", self.attrs["snapshot_ttl"], loop)
+    return future_then(future, lambda processes: loop.run_in_executor(executor, self.check, processes), loop)
 
   def monitor(self):
-    processes = self.get_process_list()
+    self.check(self.get_process_list())
+
+  def check(self, processes):
+    lines = [v if isinstance(v, string_types) else v.as_ps_line() for v in processes]
+    matches = self.pattern_set.collect(lines)
+    critical_pids = set()
     for target in self.attrs["targets"]:
-      target["__count__"] = 0
-      for process in processes:
-        if target["__pattern__"].search(process):
-          target["__count__"] += 1
+      matched = [processes[i] for i in matches[target["__index__"]]]
+      target["__count__"] = len(matched)
+      if target["critical"]:
+        critical_pids.update(v.pid for v in matched if isinstance(v, ProcessInfo))
       if target["__count__"] < target.get("min", -1):
         target.change_state("min", target["level"])
       elif target["__count__"] > target.get("max",99999):
         target.change_state("max", target["level"])
       else:
-        target.change_state("normal", Event.INFO)
+        state = self.check_resources(target, [v for v in matched if isinstance(v, ProcessInfo)])
+        if state:
+          target.change_state(state, target["level"])
+        else:
+          target.change_state("normal", Event.INFO)
+    self.watch(critical_pids)
+
+  def watch(self, pids):
+    for pid in pids - self.watched_pids:
+      KERNEL.watcher.watch_pid((self, pid), pid, self.on_exit)
+    for pid in self.watched_pids - pids:
+      KERNEL.watcher.unwatch_pid((self, pid))
+    self.watched_pids = pids
+
+  def on_exit(self, pid):
+    LOGGER.debug("Process {} has exited.".format(pid))
+    self.refresh = True
+    self.wakeup()
+
+  def check_resources(self, target, processes):
+    if "max_rss" in target:
+      target["__rss__"] = sum(v.rss for v in processes)
+      if target["__rss__"] > target["max_rss"]:
+        return "rss"
+    if "max_cpu" in target:
+      usages = [v.cpu_percent for v in processes if v.cpu_percent is not None]
+      target["__cpu__"] = sum(usages)
+      if usages and target["__cpu__"] > target["max_cpu"]:
+        return "cpu"
+    if "max_fds" in target:
+      target["__fds__"] = sum(v.open_fds() for v in processes)
+      if target["__fds__"] > target["max_fds"]:
+        return "fds"
+    if "max_threads" in target:
+      target["__threads__"] = sum(v.threads for v in processes)
+      if target["__threads__"] > target["max_threads"]:
+        return "threads"
+    return None
+# }}}
+
+class CoProcess(BaseThread): # {{{
+  MAX_RESTART_DELAY = 60
+
+  def __init__(self, command, delimiter="", restart_delay=1, max_restarts=None, max_lines=None, max_bytes=None):
+    BaseThread.__init__(self)
+    self.command = command
+    self.delimiter = delimiter
+    self.restart_delay = restart_delay
+    self.max_restarts = max_restarts
+    self.max_lines = max_lines
+    self.max_bytes = max_bytes
+    self.restarts = 0
+    self.process = None
+    self.stopping = False
+    self.lock = threading.Lock()
+    self.seq = 0
+    self.block = None
+    self.published_at = time.time()
+
+  def stop(self):
+    self.stopping = True
+    self.kill()
+    self.queue.put(STOP_THREAD)
+    self.join()
+
+  def kill(self):
+    try:
+      if self.process is not None and self.process.poll() is None:
+        # kill the whole process group, shell pipelines hold the pipe too
+        os.killpg(self.process.pid, signal.SIGKILL)
+    except OSError:
+      pass
+
+  def latest(self):
+    with self.lock:
+      return self.seq, self.block, self.published_at
+
+  def publish(self, lines):
+    with self.lock:
+      self.seq += 1
+      self.block = lines
+      self.published_at = time.time()
+
+  def read(self):
+    self.process = subprocess.Popen(self.command, shell=(not isinstance(self.command, (list, tuple))),
+                                    stdout=subprocess.PIPE, close_fds=True, **NEW_SESSION)
+    if self.stopping:
+      self.kill()
+    published = False
+    # a block over the limits is dropped, and so is the rest of a line
+    # longer than max_bytes.
+    lines, size, dropped, continued = [], 0, False, False
+    limit = self.max_bytes + 1 if self.max_bytes else -1
+    for data in iter(lambda: self.process.stdout.readline(limit), b_("")):
+      size += len(data)
+      partial = not data.endswith(b_("\n"))
+      if continued:
+        continued = partial
+        continue
+      continued = partial
+      line = u_(data, errors="replace").rstrip(u_("\r\n"))
+      if line == self.delimiter and not partial:
+        if dropped:
+          LOGGER.error("Co-process {} wrote a block over {} lines or {} bytes, dropped it.".format(
+            self.command, self.max_lines, self.max_bytes))
+        else:
+          self.publish(lines)
+          published = True
+        lines, size, dropped = [], 0, False
+      elif not dropped:
+        lines.append(line)
+        if (self.max_lines and len(lines) > self.max_lines) or (self.max_bytes and size > self.max_bytes):
+          lines, dropped = [], True
+    self.process.stdout.close()
+    self.process.wait()
+    return published
+
+  def run(self):
+    failures = 0
+    while True:
+      try:
+        failures = 0 if self.read() else failures + 1
+      except OSError as e:
+        failures += 1
+        LOGGER.error("Failed to start a co-process {}: {}".format(self.command, u_(e)))
+      if self.stopping:
+        break
+      self.restarts += 1
+      if self.max_restarts is not None and self.restarts > self.max_restarts:
+        LOGGER.error("Co-process {} exited too many times.".format(self.command))
+        break
+      delay = min(self.restart_delay * 2 ** max(failures - 1, 0), CoProcess.MAX_RESTART_DELAY)
+      LOGGER.warning("Co-process {} exited, restarting in {} secs.".format(self.command, delay))
+      try:
+        if self.queue.get(timeout=delay) is STOP_THREAD:
+          break
+      except queue.Empty:
+        pass
+# }}}
+
+class RingBuffer(object): # {{{
+  ITEM_SIZE = array.array("d").itemsize
+
+  def __init__(self, size, percentiles=False):
+    self.size = size
+    self.values = array.array("d", [0.0]) * size
+    self.times = array.array("d", [0.0]) * size
+    self.sorted = array.array("d") if percentiles else None
+    self.head = 0
+    self.count = 0
+    self.sum = 0.0
+
+  @classmethod
+  def memory(cls, size, percentiles=False):
+    return cls.ITEM_SIZE * size * (3 if percentiles else 2)
+
+  def nbytes(self):
+    return RingBuffer.memory(self.size, self.sorted is not None)
+
+  def append(self, value, t):
+    value = float(value)
+    if self.count == self.size:
+      old = self.values[self.head]
+      self.sum -= old
+      if self.sorted is not None:
+        del self.sorted[bisect.bisect_left(self.sorted, old)]
+    else:
+      self.count += 1
+    self.values[self.head] = value
+    self.times[self.head] = t
+    self.sum += value
+    if self.sorted is not None:
+      # O(size) for moving items of the sorted copy, a plain memmove that
+      # is cheap for windows of a few thousand samples.
+      bisect.insort(self.sorted, value)
+    self.head = (self.head + 1) % self.size
+    if self.head == 0:
+      # cancels rounding errors accumulated in the running sum.
+      self.sum = math.fsum(self.values)
+
+  def full(self):
+    return self.count == self.size
+
+  def average(self):
+    return self.sum / self.count
+
+  def percentile(self, p):
+    return self.sorted[max(int(math.ceil(p / 100.0 * self.count)) - 1, 0)]
+
+  def rate(self):
+    # change per second between the oldest and the newest samples.
+    newest = (self.head - 1) % self.size
+    oldest = self.head if self.full() else 0
+    elapsed = self.times[newest] - self.times[oldest]
+    if elapsed <= 0:
+      return 0.0
+    return (self.values[newest] - self.values[oldest]) / elapsed
 # }}}
 
 class CommandOutputVarMonitor(Monitor): # {{{
+  WINDOW_CHECKS = (
+    ("avg", lambda window: window.average()),
+    ("p95", lambda window: window.percentile(95)),
+    ("p99", lambda window: window.percentile(99)),
+    ("rate", lambda window: window.rate()),
+  )
+  VAR = re.compile(r"([^=]+)=([\-\+]?\d+)(\.\d+)?")
+  GLOB = re.compile(r"[*?\[]")
+
   def default_attrs(self):
     attrs = Monitor.default_attrs(self)
     attrs["logger"] = None
+    attrs["persistent"] = False
+    attrs["delimiter"] = ""
+    attrs["block_timeout"] = None
+    attrs["restart_delay"] = 1
+    attrs["max_restarts"] = None
+    attrs["max_block_lines"] = 10000
+    attrs["timeout"] = None
+    attrs["max_output"] = None
+    attrs["window_memory"] = 16*1024*1024
+    attrs["expire_after"] = 3600
+    attrs["store"] = False
     attrs["messages"]["gt"] = "{name}: {__value__} (> {gt})."
     attrs["messages"]["lt"] = "{name}: {__value__} (< {lt})."
     attrs["messages"]["ne"] = "{name}: {__value__} (!= {ne})"
     attrs["messages"]["command_e"] = "{__command__} : Invalid output. var {name} not found."
+    attrs["messages"]["avg_gt"] = "{name}: average {__avg__:.2f} of {window} samples (> {avg_gt})."
+    attrs["messages"]["avg_lt"] = "{name}: average {__avg__:.2f} of {window} samples (< {avg_lt})."
+    attrs["messages"]["p95_gt"] = "{name}: p95 {__p95__} of {window} samples (> {p95_gt})."
+    attrs["messages"]["p95_lt"] = "{name}: p95 {__p95__} of {window} samples (< {p95_lt})."
+    attrs["messages"]["p99_gt"] = "{name}: p99 {__p99__} of {window} samples (> {p99_gt})."
+    attrs["messages"]["p99_lt"] = "{name}: p99 {__p99__} of {window} samples (< {p99_lt})."
+    attrs["messages"]["rate_gt"] = "{name}: {__rate__:.2f}/sec in {window} samples (> {rate_gt})."
+    attrs["messages"]["rate_lt"] = "{name}: {__rate__:.2f}/sec in {window} samples (< {rate_lt})."
     attrs["messages"]["normal"] = "{name}: Resume normal operations."
     return attrs
 
   def init_attrs(self):
     Monitor.init_attrs(self)
+    self.window_memory = 0
+    # exact names are looked up in the index, glob targets are expanded
+    # into a target per matching variable.
+    self.index = {}
+    self.globs = []
+    self.expanded = {}
+    self.seen = {}
     for target in self.attrs["targets"]:
-      target["__value__"] = 0
+      if CommandOutputVarMonitor.GLOB.search(target["name"]):
+        self.globs.append(target)
+      else:
+        self.init_target(target)
+        self.index.setdefault(target["name"], []).append(target)
+    self.coprocess = None
+    self.block_seq = 0
+
+  def init_target(self, target):
+    target["__value__"] = 0
+    target["__command__"] = self.attrs["command"]
+    target["__window__"] = self.allocate_window(target)
+
+  def expand(self, name):
+    targets = self.index.get(name, [])
+    if self.globs:
+      expanded = self.expanded.get(name)
+      if expanded is None:
+        expanded = self.expanded[name] = []
+        for spec in self.globs:
+          if fnmatch.fnmatchcase(name, spec["name"]):
+            attrs = dict((k, v) for k, v in iter_items(spec.attrs) if not k.startswith("__"))
+            attrs["name"] = name
+            target = Target(self, attrs)
+            self.init_target(target)
+            expanded.append(target)
+      if expanded:
+        targets = targets + expanded
+    return targets
+
+  def allocate_window(self, target):
+    names = [name for name, _ in CommandOutputVarMonitor.WINDOW_CHECKS
+             if name + "_gt" in target or name + "_lt" in target]
+    if not names:
+      return None
+    if "window" not in target:
+      target["window"] = 10
+    percentiles = "p95" in names or "p99" in names
+    memory = RingBuffer.memory(target["window"], percentiles)
+    if self.window_memory + memory > self.attrs["window_memory"]:
+      LOGGER.error("Window of {} exceeds window_memory({} bytes).".format(target["name"], self.attrs["window_memory"]))
+      return None
+    self.window_memory += memory
+    return RingBuffer(target["window"], percentiles)
+
+  def stop(self):
+    Monitor.stop(self)
+    if self.coprocess is not None:
+      self.coprocess.stop()
 
   def log_values(self, values):
     buf = []
@@ -308,43 +1894,433 @@ class CommandOutputVarMonitor(Monitor): # {{{
     self.attrs["logger"](log)
 
   def get_values(self):
-    output = p_out(self.attrs["command"]).splitlines()
+    if callable(self.attrs["command"]):
+      return self.attrs["command"]()
+    if self.attrs["persistent"]:
+      return self.read_block()
+    return self.parse_values(p_out(self.attrs["command"], self.attrs["timeout"], self.attrs["max_output"]))
+
+  def read_block(self):
+    if self.coprocess is None:
+      max_output = COMMAND_RUNNER.limits(None, self.attrs["max_output"])[1]
+      self.coprocess = CoProcess(self.attrs["command"], self.attrs["delimiter"],
+                                 self.attrs["restart_delay"], self.attrs["max_restarts"],
+                                 self.attrs["max_block_lines"], max_output)
+      self.coprocess.start()
+    # the latest block is checked without waiting for the co-process, and
+    # variables are missing when no block was written for block_timeout.
+    seq, block, published_at = self.coprocess.latest()
+    if time.time() - published_at > (self.attrs["block_timeout"] or 2 * self.attrs["interval"]):
+      return {}
+    if seq == self.block_seq:
+      return None
+    self.block_seq = seq
+    return self.parse_values(u_("\n").join(block))
+
+  def parse_values(self, output):
     values = {}
-    for line in output:
-      m = re.match("([^=]+)=([\-\+]?\d+\.\d+)", line)
+    match = CommandOutputVarMonitor.VAR.match
+    for line in u_(output, errors="replace").splitlines():
+      m = match(line)
       if m:
-        values[m.group(1)] = float(m.group(2))
-      else:
-        m = re.match("([^=]+)=([\-\+]?\d+)", line)
-        if m:
+        if m.group(3):
+          values[m.group(1)] = float(m.group(2) + m.group(3))
+        else:
           values[m.group(1)] = int(m.group(2))
     return values
 
+  def async_monitor(self, loop, executor):
+    if type(self).get_values is not CommandOutputVarMonitor.get_values or callable(self.attrs["command"]) or self.attrs["persistent"]:
+      return Monitor.async_monitor(self, loop, executor)
+    return future_then(async_p_out(self.attrs["command"], loop, self.attrs["timeout"], self.attrs["max_output"]),
+                       lambda out: self.check(self.parse_values(out)), loop)
+
   def monitor(self):
     values = self.get_values()
+    # None means no new values yet.
+    if values is not None:
+      self.check(values)
+
+  def check(self, values):
     if self.attrs["logger"]:
       self.log_values(values)
-    for target in self.attrs["targets"]:
-      target["__command__"] = self.attrs["command"]
-      if target["name"] not in values:
-        target.change_state("command_e", Event.ERROR)
+    now = time.time()
+    if self.attrs["store"]:
+      for name, value in iter_items(values):
+        KERNEL.store.append(name, value, now)
+      KERNEL.store.flush()
+    for name, value in iter_items(values):
+      for target in self.expand(name):
+        self.check_target(target, value, now)
+    for name, targets in iter_items(self.index):
+      if name not in values:
+        for target in targets:
+          target.change_state("command_e", Event.ERROR)
+    if self.globs:
+      self.expire(values, now)
+
+  def expire(self, values, now):
+    # targets expanded for variables missing for expire_after secs are
+    # removed with their windows.
+    for name in values:
+      self.seen[name] = now
+    for name, seen_at in list(iter_items(self.seen)):
+      if now - seen_at < self.attrs["expire_after"]:
         continue
-      value = values[target["name"]]
-      target["__value__"] = value
-
-      if "lt" in target and value < target["lt"]:
-        target.change_state("lt", target["level"])
-      elif "gt" in target and value > target["gt"]:
-        target.change_state("gt", target["level"])
-      elif "ne" in target and value != target["ne"]:
-        target.change_state("ne", target["level"])
+      del self.seen[name]
+      for target in self.expanded.pop(name, []):
+        if target["__window__"] is not None:
+          self.window_memory -= target["__window__"].nbytes()
+
+  def check_target(self, target, value, now):
+    target["__value__"] = value
+    if target["__window__"] is not None:
+      target["__window__"].append(value, now)
+
+    if "lt" in target and value < target["lt"]:
+      target.change_state("lt", target["level"])
+    elif "gt" in target and value > target["gt"]:
+      target.change_state("gt", target["level"])
+    elif "ne" in target and value != target["ne"]:
+      target.change_state("ne", target["level"])
+    else:
+      state = self.check_window(target)
+      if state is not None:
+        target.change_state(state, target["level"])
       else:
         target.change_state("normal", Event.INFO)
+
+  def check_window(self, target):
+    # windowed thresholds are checked once the window is filled.
+    window = target["__window__"]
+    if window is None or not window.full():
+      return None
+    for name, func in CommandOutputVarMonitor.WINDOW_CHECKS:
+      gt, lt = name + "_gt", name + "_lt"
+      if gt not in target and lt not in target:
+        continue
+      value = target["__{}__".format(name)] = func(window)
+      if lt in target and value < target[lt]:
+        return lt
+      if gt in target and value > target[gt]:
+        return gt
+    return None
+# }}}
+
+class SysInfo(object): # {{{
+  def __init__(self, proc_dir="/proc", sys_dir="/sys"):
+    self.proc_dir = proc_dir
+    self.sys_dir = sys_dir
+    self.cpu = None
+    self.devices = None
+
+  def __str__(self):
+    return "sysinfo"
+
+  def __call__(self):
+    values = {}
+    self.collect_cpu(values)
+    self.collect_load_average(values)
+    self.collect_memory(values)
+    self.collect_disk_usage(values)
+    self.collect_devices(values)
+    return values
+
+  def read_lines(self, name):
+    with open(os.path.join(self.proc_dir, name)) as io:
+      return io.read().splitlines()
+
+  def collect_cpu(self, values):
+    # same as the "us" of top: user time since the previous call.
+    fields = [int(v) for v in self.read_lines("stat")[0].split()[1:]]
+    cpu = (fields[0], sum(fields))
+    last = self.cpu or (0, 0)
+    self.cpu = cpu
+    total = cpu[1] - last[1]
+    values["CPU_USAGE"] = int((cpu[0] - last[0]) * 100 / total) if total > 0 else 0
+
+  def collect_load_average(self, values):
+    fields = self.read_lines("loadavg")[0].split()
+    values["LOAD_AVERAGE_1"] = float(fields[0])
+    values["LOAD_AVERAGE_5"] = float(fields[1])
+    values["LOAD_AVERAGE_15"] = float(fields[2])
+
+  def collect_memory(self, values):
+    meminfo = {}
+    for line in self.read_lines("meminfo"):
+      name, value = line.split(":", 1)
+      meminfo[name] = int(value.split()[0])
+    unused = meminfo["MemFree"] + meminfo.get("Buffers", 0) + meminfo.get("Cached", 0)
+    values["MEM_USAGE"] = int((meminfo["MemTotal"] - unused) * 100 / meminfo["MemTotal"])
+    if meminfo.get("SwapTotal", 0) == 0:
+      values["SWAP_USAGE"] = 0
+    else:
+      values["SWAP_USAGE"] = int((meminfo["SwapTotal"] - meminfo["SwapFree"]) * 100 / meminfo["SwapTotal"])
+
+  def collect_disk_usage(self, values):
+    unescape = lambda v: re.sub(r"\\([0-7]{3})", lambda m: chr(int(m.group(1), 8)), v)
+    for line in self.read_lines("mounts"):
+      fields = line.split()
+      if fields[0] == "none":
+        continue
+      try:
+        st = os.statvfs(unescape(fields[1]))
+      except OSError:
+        continue
+      if st.f_blocks == 0:
+        continue
+      used = st.f_blocks - st.f_bfree
+      # same as df: rounds up.
+      values["DISK_USAGE_" + unescape(fields[1])] = -(-used * 100 // (used + st.f_bavail)) if used + st.f_bavail else 0
+
+  def collect_devices(self, values):
+    now = time.time()
+    devices = {}
+    for line in self.read_lines("diskstats"):
+      fields = line.split()
+      name = fields[2]
+      if not os.path.exists(os.path.join(self.sys_dir, "block", name.replace("/", "!"))):
+        continue
+      devices[name] = (int(fields[5]), int(fields[9]), int(fields[12]))
+    last = self.devices
+    self.devices = (now, devices)
+    if last is None or now <= last[0]:
+      return
+    t = now - last[0]
+    for name, stat in iter_items(devices):
+      if name not in last[1]:
+        continue
+      rsectors, wsectors, ticks = [v - w for v, w in zip(stat, last[1][name])]
+      values["DEV_RKBS_" + name] = round(rsectors * 512 / 1024.0 / t, 2)
+      values["DEV_WKBS_" + name] = round(wsectors * 512 / 1024.0 / t, 2)
+      values["DEV_UTIL_" + name] = round(min(ticks / (t * 10.0), 100.0), 2)
+# }}}
+
+class LogFile(object): # {{{
+  CHUNK_SIZE = 1024*1024
+  MMAP_SIZE = 64*1024*1024
+  SEGMENT_SIZE = 16*1024*1024
+  NEWLINE = b_("\n")
+  OPENERS = {".gz": gzip.open}
+  if bz2 is not None:
+    OPENERS[".bz2"] = bz2.BZ2File
+  if lzma is not None:
+    OPENERS[".xz"] = lzma.open
+
+  def __init__(self, path, encoding="utf8"):
+    self.path = path
+    self.encoding = encoding
+    self.io = None
+    self.stat = None
+    self.header = None
+    self.position = 0
+    self.compressed = False
+    self.at_end = False
+    self.limited = False
+    # the event target, the saved file_stat row and the lines of an
+    # incomplete record of monitors.
+    self.target = None
+    self.row = None
+    self.record = []
+    self.record_position = 0
+    self.record_at = 0
+    self.backlog = 0
+    self.skipped = 0
+    # a rotated file read before this one, and the path under which the
+    # position is saved.
+    self.draining = None
+    self.key = path
+
+  def open(self):
+    # compressed files are read as a stream of uncompressed bytes.
+    self.close()
+    opener = LogFile.OPENERS.get(os.path.splitext(self.path)[1])
+    self.compressed = opener is not None
+    io = (opener or open)(self.path, "rb")
+    try:
+      self.stat = os.stat(self.path) if self.compressed else os.fstat(io.fileno())
+      self.header = self.read_header(io)
+    except:
+      io.close()
+      raise
+    self.io = io
+    self.position = 0
+    return io
+
+  def close(self):
+    if self.io is not None:
+      self.io.close()
+      self.io = None
+
+  def detach(self):
+    # moves the open file to another LogFile, so that the rest of it is
+    # read while this one opens the file created at the path.
+    rotated = LogFile(self.path, self.encoding)
+    for name in ("io", "stat", "header", "position", "compressed", "target", "record", "record_position", "record_at", "key"):
+      setattr(rotated, name, getattr(self, name))
+    self.io = self.stat = None
+    self.record = []
+    return rotated
+
+  def read_header(self, io):
+    # an incomplete first line is not a header yet.
+    where = io.tell()
+    io.seek(0)
+    line = io.readline()
+    io.seek(where)
+    if not line.endswith(b_("\n")):
+      return u_("")
+    return self.decode(line).strip()
+
+  def decode(self, line):
+    return u_(line, self.encoding, "replace")
+
+  def remaining(self):
+    # bytes not read yet. the size of a compressed file is not known.
+    if self.io is None or self.compressed:
+      return 0
+    return max(os.fstat(self.io.fileno()).st_size - self.position, 0)
+
+  def skip_to_end(self):
+    # skips to the end of the last complete line, returns skipped bytes.
+    size = os.fstat(self.io.fileno()).st_size
+    start = max(size - LogFile.CHUNK_SIZE, self.position)
+    self.io.seek(start)
+    end = self.io.read(size - start).rfind(LogFile.NEWLINE) + 1
+    position = self.position
+    if end > 0:
+      self.position = start + end
+    elif start > self.position:
+      self.position = start
+    return self.position - position
+
+  def rewind(self):
+    self.position = 0
+    self.stat = os.fstat(self.io.fileno())
+    self.header = self.read_header(self.io)
+
+  def changed(self):
+    # returns "rotated" when another file has been created at the path,
+    # a removed file is read until a new one appears.
+    try:
+      stat = os.stat(self.path)
+      if (stat.st_ino, stat.st_dev) != (self.stat.st_ino, self.stat.st_dev):
+        return "rotated"
+    except OSError:
+      pass
+    # compressed files are not written any more, and their sizes are not
+    # comparable with positions in the uncompressed stream.
+    if self.compressed:
+      return None
+    stat = os.fstat(self.io.fileno())
+    if stat.st_size < self.position:
+      return "truncated"
+    if stat.st_size != self.stat.st_size:
+      self.stat = stat
+      header = self.read_header(self.io)
+      if self.header and header != self.header:
+        return "rewritten"
+      self.header = header
+    return None
+
+  def lines(self, prefilter=None, final=False, max_bytes=None, deadline=None):
+    # yields complete lines as bytes. lines that the prefilter does not
+    # find are skipped, and self.position is the offset after the last
+    # line read. an incomplete last line is left unread unless final.
+    # reading stops at the end of the last complete line within max_bytes
+    # or after the deadline, and self.limited is set then.
+    self.at_end = self.limited = False
+    start = self.position
+    limit = None if max_bytes is None else start + max(max_bytes, 0)
+    size = self.stat.st_size if self.compressed else os.fstat(self.io.fileno()).st_size
+    if mmap is not None and not self.compressed and size - self.position >= LogFile.MMAP_SIZE:
+      buf = mmap.mmap(self.io.fileno(), size, access=mmap.ACCESS_READ)
+      try:
+        while size - self.position >= LogFile.MMAP_SIZE:
+          if self.over_limit(start, limit, deadline):
+            self.limited = True
+            return
+          stop = min(self.position + LogFile.SEGMENT_SIZE, size)
+          if limit is not None and limit > self.position:
+            stop = min(stop, limit)
+          end = buf.rfind(LogFile.NEWLINE, self.position, stop) + 1
+          if end == 0:
+            # a line longer than the segment.
+            end = buf.find(LogFile.NEWLINE, stop, size) + 1
+            if end == 0:
+              break
+          for line in self.scan(buf, 0, self.position, end, prefilter):
+            yield line
+      finally:
+        buf.close()
+
+    self.io.seek(self.position)
+    rest = b_("")
+    while True:
+      if self.over_limit(start, limit, deadline):
+        self.limited = True
+        return
+      chunk = self.io.read(LogFile.CHUNK_SIZE)
+      if not chunk:
+        self.at_end = True
+        break
+      buf = rest + chunk
+      end = buf.rfind(LogFile.NEWLINE) + 1
+      if end == 0:
+        rest = buf
+        continue
+      capped = limit is not None and self.position + end > limit
+      if capped:
+        end = buf.rfind(LogFile.NEWLINE, 0, max(limit - self.position, 0)) + 1
+        if end == 0:
+          if self.position > start:
+            self.limited = True
+            return
+          end = buf.find(LogFile.NEWLINE) + 1
+      for line in self.scan(buf, self.position, 0, end, prefilter):
+        yield line
+      if capped:
+        self.limited = True
+        return
+      rest = buf[end:]
+    if final and rest:
+      self.position += len(rest)
+      yield rest
+
+  def over_limit(self, start, limit, deadline):
+    # a line is read at least so that readers always make progress.
+    if self.position == start:
+      return False
+    return (limit is not None and self.position >= limit) or (deadline is not None and time.time() >= deadline)
+
+  def scan(self, buf, base, start, end, prefilter):
+    # buf[start:end] holds complete lines, and buf[0] is at offset base.
+    newline = LogFile.NEWLINE
+    pos = start
+    while pos < end:
+      if prefilter is None:
+        line_start = pos
+      else:
+        m = prefilter.search(buf, pos, end)
+        if m is None:
+          break
+        line_start = buf.rfind(newline, pos, m.start()) + 1 or pos
+      line_end = buf.find(newline, line_start, end) + 1
+      self.position = base + line_end
+      yield buf[line_start:line_end]
+      pos = line_end
+    self.position = base + end
 # }}}
 
 class LogMonitor(Monitor): # {{{
+  MAX_ROTATED_FILES = 5
+  INLINE_FLAGS = re.compile(r"\(\?[aiLmsux]+\)")
+
   def __init__(self, attrs):
     self.monitor_target = Target(self, attrs)
+    self.start_tick()
+    self.notify_lock = threading.Lock()
+    self.notify_timer = None
     Monitor.__init__(self, attrs)
 
   def default_attrs(self):
@@ -352,109 +2328,572 @@ class LogMonitor(Monitor): # {{{
     attrs["messages"]["not_readable_error"] = "File {file} is not readable or not exists."
     attrs["messages"]["truncated"] = "File {file} was truncated."
     attrs["messages"]["rewritten"] = "File {file} was rewritten."
+    attrs["messages"]["rotated"] = "File {file} was rotated."
+    attrs["messages"]["recovered"] = "Read the rest of the file {file} from {__rotated__}."
+    attrs["messages"]["aggregated"] = "{__file__}: {message}({__count__} lines, first: {__first_line__}, last: {__last_line__})"
     attrs["messages"]["opened"] = "Open the file {file}(position: {__seek__})."
+    attrs["messages"]["skipped"] = "Skipped {__skipped__} bytes of the file {file}."
     attrs["messages"]["error"] = "{__file__}: {message}({__line__})"
     attrs["messages"]["warn"] = "{__file__}: {message}({__line__})"
     attrs["messages"]["info"] = "{__file__}: {message}({__line__})"
+    attrs["checkpoint_lines"] = 1000
+    attrs["checkpoint_interval"] = 1
+    attrs["inotify"] = False
+    attrs["inotify_delay"] = 0.2
+    attrs["archives"] = []
+    attrs["record_start"] = None
+    attrs["continuation"] = None
+    attrs["max_record_lines"] = 1000
+    attrs["record_timeout"] = 1
+    attrs["max_tick_lines"] = 100000
+    attrs["max_tick_bytes"] = 64 * 1024 * 1024
+    attrs["max_tick_time"] = 1
+    attrs["max_backlog"] = None
     return attrs
 
-  def update_seek(self, pos):
-    def f(conn):
-      cur = conn.cursor()
-      cur.execute("BEGIN")
-      cur.execute("update file_stat set seek = ?, header = ? where file=?", (pos, self.monitor_target["__header__"], self.attrs["file"]))
-      conn.commit()
-    KERNEL.db_thread.execute(f, sync=False)
+  def update_seek(self, logfile, pos):
+    KERNEL.db_thread.checkpoint(logfile.key, pos, logfile.header)
 
   def close_file(self):
-    if self.monitor_target["__io__"] is not None:
-      self.monitor_target["__io__"].close()
-      self.monitor_target["__io__"] = None
+    self.close_logfile(self.logfile)
+    if self.archive is not None:
+      self.archive.close()
+
+  def close_logfile(self, logfile):
+    logfile.close()
+    if logfile.draining is not None:
+      logfile.draining.close()
+      logfile.draining = None
 
   def stop(self):
     Monitor.stop(self)
+    if self.attrs["inotify"]:
+      KERNEL.watcher.unwatch_path(self)
+      self.cancel_notify()
     self.close_file()
+    self.flush_aggregations(force=True)
 
   def init_attrs(self):
     Monitor.init_attrs(self)
+    self.init_patterns()
+    self.logfile = LogFile(self.attrs["file"], self.attrs.get("encoding", "utf8"))
+    self.logfile.target = self.monitor_target
+    self.scanned = False
+    self.archive = None
+    self.open_file(self.logfile)
+
+  def init_patterns(self):
     for target in self.attrs["targets"]:
       target["__pattern__"] = re.compile(target["pattern"])
-      target["__file__"] = self.attrs["file"]
-    self.open_file()
-
-  def open_file(self):
-    self.close_file()
+      target["__file__"] = self.attrs.get("file")
+    self.pattern_set = PatternSet([v["__pattern__"] for v in self.attrs["targets"]], method="match")
+    self.prefilter = self.pattern_set.bytes_prefilter(self.attrs.get("encoding", "utf8"))
+    self.record_start = self.continuation = None
+    if self.attrs["record_start"] is not None:
+      self.record_start = re.compile(self.attrs["record_start"])
+    elif self.attrs["continuation"] is not None:
+      self.continuation = re.compile(self.attrs["continuation"])
+    if self.record_start or self.continuation:
+      # every line is needed to find the records, and a record matches
+      # if one of its lines matches.
+      self.prefilter = None
+      self.pattern_set = PatternSet([self.record_pattern(v["__pattern__"]) for v in self.attrs["targets"]], method="search")
+
+  def record_pattern(self, pattern):
+    # matches at the start of any line of a record. inline flags must stay
+    # at the start of the pattern.
+    flags = LogMonitor.INLINE_FLAGS.match(pattern.pattern)
+    prefix = flags.group(0) if flags else u_("")
     try:
-      self.monitor_target["__io__"] = codecs.open(self.attrs["file"], encoding=self.attrs.get("encoding", "utf8"))
-      self.monitor_target["__size__"] = os.path.getsize(self.attrs["file"])
-      self.monitor_target["__header__"] = self.monitor_target["__io__"].readline().strip()
-      self.monitor_target["__io__"].seek(0)
-    except:
-      self.monitor_target.change_state("not_readable_error", Event.ERROR)
+      return re.compile(u_("{}^(?:{})").format(prefix, pattern.pattern[len(prefix):]), pattern.flags | re.MULTILINE)
+    except re.error as e:
+      raise ValueError("Pattern {} can not be used for records: {}".format(pattern.pattern, u_(e)))
+
+  def load_row(self, logfile):
+    saved = KERNEL.db_thread.saved_checkpoint(logfile.path)
+    if saved is None:
+      KERNEL.db_thread.checkpoint(logfile.path, 0, logfile.header)
+      return [logfile.path, 0, logfile.header]
+    return [logfile.path, saved[0], saved[1]]
+
+  def find_rotated(self, logfile, header):
+    # a recently rotated file, possibly compressed, that starts with the header.
+    def mtime(path):
+      try:
+        return os.path.getmtime(path)
+      except OSError:
+        return 0
+    paths = set(glob.glob(logfile.path + ".*") + glob.glob(logfile.path + "-*"))
+    for path in sorted(paths, key=mtime, reverse=True)[:LogMonitor.MAX_ROTATED_FILES]:
+      rotated = LogFile(path, logfile.encoding)
+      try:
+        rotated.open()
+      except (IOError, OSError, EOFError):
+        continue
+      if rotated.header == header:
+        return rotated
+      rotated.close()
+    return None
+
+  def recover(self, logfile, header, position):
+    # drains the lines after the position that were rotated while the
+    # file was not open.
+    if not header:
       return
-
-    def f(conn):
-      cur = conn.cursor()
-      cur.execute("select * from file_stat where file=?", (self.attrs["file"],))
-      row = list(cur.fetchone() or [])
-      if not row:
-        cur.execute("BEGIN")
-        cur.execute("insert into file_stat values (?, ?, ?)", (self.attrs["file"], 0, self.monitor_target["__header__"]))
-        conn.commit()
-        row = [self.attrs["file"], 0, self.monitor_target["__header__"]]
-      return row
-    row = KERNEL.db_thread.execute(f)
-    if self.monitor_target["__io__"]:
-      if self.monitor_target["__size__"] < row[1]:
-        self.monitor_target.change_state("truncated", Event.INFO)
-        self.monitor_target["__io__"].seek(0)
-        self.update_seek(0)
-        row = [self.attrs["file"], 0]
-      elif self.monitor_target["__header__"] != row[2]:
-        self.monitor_target.change_state("rewritten", Event.INFO)
-        self.monitor_target["__io__"].seek(0)
-        self.update_seek(0)
-        row = [self.attrs["file"], 0, self.monitor_target["__header__"]]
+    rotated = self.find_rotated(logfile, header)
+    if rotated is None:
+      return
+    rotated.target = logfile.target
+    rotated.key = logfile.key
+    rotated.position = position
+    logfile.target["__rotated__"] = rotated.path
+    logfile.target.change_state("recovered", Event.INFO)
+    logfile.draining = rotated
+
+  def drain(self, logfile):
+    # reads the rest of a rotated file within the budget, returns False
+    # until it has been read to the end. the saved position stays in the
+    # rotated file until then, so that it is recovered after a restart.
+    rotated = logfile.draining
+    try:
+      if not self.read_lines(rotated, final=True):
+        return False
+    except (IOError, OSError, EOFError) as e:
+      LOGGER.error("Failed to read {}: {}".format(rotated.path, u_(e)))
+    rotated.close()
+    logfile.draining = None
+    if logfile.io is not None:
+      self.update_seek(logfile, self.checkpoint_position(logfile))
+    return True
+
+  def archive_key(self, path):
+    # archives are identified by the device, the inode and the size, so
+    # that a renamed archive is not read again while a new archive that
+    # reuses an inode is.
+    try:
+      stat = os.stat(path)
+    except OSError:
+      return None
+    return u_("archive:{:d}:{:d}:{:d}").format(stat.st_dev, stat.st_ino, stat.st_size)
+
+  def scan(self, path, key):
+    # reads an archive once within the tick budget, returns False when
+    # the rest is read in the next tick. the progress and the path are
+    # saved under the key, and -1 marks a scanned archive.
+    saved = KERNEL.db_thread.saved_checkpoint(key)
+    if saved is not None and saved[0] < 0:
+      if saved[1] != path:
+        KERNEL.db_thread.checkpoint(key, -1, path)
+      return True
+    if self.over_budget():
+      self.behind = True
+      return False
+    logfile = self.archive
+    if logfile is None or logfile.path != path:
+      logfile = LogFile(path, self.attrs.get("encoding", "utf8"))
+      logfile.target = Target(self, dict(self.attrs, file=path))
+    try:
+      if logfile.io is None:
+        logfile.open()
+        logfile.position = saved[0] if saved is not None else 0
+      done = self.read_lines(logfile, final=True, checkpoint=False)
+    except (IOError, OSError, EOFError) as e:
+      LOGGER.error("Failed to scan {}: {}".format(path, u_(e)))
+      logfile.close()
+      self.archive = None
+      return True
+    if done:
+      KERNEL.db_thread.checkpoint(key, -1, path)
+      logfile.close()
+      self.archive = None
+      return True
+    KERNEL.db_thread.checkpoint(key, self.checkpoint_position(logfile), path)
+    self.archive = logfile
+    return False
+
+  def scan_archives(self):
+    if not self.scanned:
+      keys = set()
+      for pattern in self.attrs["archives"]:
+        for path in sorted(glob.glob(pattern)):
+          key = self.archive_key(path)
+          if key is None:
+            continue
+          keys.add(key)
+          if not self.scan(path, key):
+            return
+      # markers of archives that are gone and matched the patterns.
+      KERNEL.db_thread.remove_checkpoints([
+        file for file, seek, path in KERNEL.db_thread.saved_checkpoints(u_("archive:"))
+        if file not in keys and any(fnmatch.fnmatch(path, v) for v in self.attrs["archives"])])
+      self.scanned = True
+
+  def notify(self):
+    # ticks woken up by inotify are at least inotify_delay secs apart, so
+    # a busy file does not make the monitor tick continuously.
+    with self.notify_lock:
+      if self.notify_timer is not None:
+        return
+      delay = self.tick_started_at + self.attrs["inotify_delay"] - time.time()
+      if delay > 0:
+        self.notify_timer = threading.Timer(delay, self.notified)
+        self.notify_timer.daemon = True
+        self.notify_timer.start()
+        return
+    self.wakeup()
+
+  def notified(self):
+    with self.notify_lock:
+      self.notify_timer = None
+    self.wakeup()
+
+  def cancel_notify(self):
+    with self.notify_lock:
+      if self.notify_timer is not None:
+        self.notify_timer.cancel()
+        self.notify_timer = None
+
+  def watch(self, logfile):
+    if self.attrs["inotify"]:
+      # a file created after a rotation is a new inode to watch.
+      KERNEL.watcher.watch_path(self, logfile.path, self.notify)
+
+  def open_file(self, logfile):
+    self.watch(logfile)
+    target = logfile.target
+    previous, position, header = logfile.stat, logfile.position, logfile.header
+    try:
+      logfile.open()
+    except (IOError, OSError):
+      target.change_state("not_readable_error", Event.ERROR)
+      return False
+    target["__header__"] = logfile.header
+
+    # the saved position is used only for the first file, files opened
+    # after a rotation are read from the beginning.
+    seek = 0
+    if logfile.row is None:
+      logfile.row = self.load_row(logfile)
+      if not logfile.compressed and logfile.stat.st_size < logfile.row[1]:
+        target.change_state("truncated", Event.INFO)
+        self.update_seek(logfile, 0)
+        self.recover(logfile, logfile.row[2], logfile.row[1])
+      elif logfile.row[2] and logfile.header != logfile.row[2]:
+        target.change_state("rewritten", Event.INFO)
+        self.update_seek(logfile, 0)
+        self.recover(logfile, logfile.row[2], logfile.row[1])
       else:
-        self.monitor_target["__io__"].seek(row[1])
-    self.monitor_target["__seek__"] = row[1]
-    self.monitor_target.change_state("opened", Event.INFO)
-    return self.monitor_target["__io__"]
+        seek = logfile.row[1]
+    elif previous is not None and (previous.st_ino, previous.st_dev) == (logfile.stat.st_ino, logfile.stat.st_dev):
+      # the same file closed and opened again.
+      seek = position
+    elif previous is not None:
+      self.recover(logfile, header, position)
+    logfile.position = seek
+    target["__seek__"] = seek
+    target.change_state("opened", Event.INFO)
+    return True
+
+  def start_tick(self):
+    self.tick_started_at = time.time()
+    self.tick_lines = 0
+    self.tick_bytes = 0
+    self.behind = False
+
+  def over_budget(self):
+    return (self.tick_lines >= self.attrs["max_tick_lines"] or
+            self.tick_bytes >= self.attrs["max_tick_bytes"] or
+            time.time() - self.tick_started_at >= self.attrs["max_tick_time"])
+
+  def tailed(self):
+    return [self.logfile]
+
+  def stats(self):
+    return dict((v.path, {"backlog": v.backlog, "skipped": v.skipped}) for v in self.tailed())
+
+  def deadline(self):
+    # aggregations and pending records are sent on time.
+    deadlines = [v["__aggregation__"]["started_at"] + v["aggregate"]
+                 for v in self.attrs["targets"] if v["__aggregation__"] is not None]
+    deadlines.extend(v.record_at + self.attrs["record_timeout"] for v in self.tailed() if v.record)
+    return min(deadlines) if deadlines else None
 
   def monitor(self):
-    io = self.monitor_target["__io__"]
-    if io is None:
-      io = self.open_file()
-      if io is None:
+    self.start_tick()
+    self.scan_archives()
+    self.tail(self.logfile)
+    self.flush_aggregations()
+    KERNEL.db_thread.flush()
+    if self.behind:
+      # the rest is read in the next slot instead of the next interval.
+      self.wakeup()
+
+  def tail(self, logfile):
+    target = logfile.target
+    if logfile.draining is not None and not self.drain(logfile):
+      return
+    if logfile.io is None:
+      if not self.open_file(logfile):
         return
     else:
-      self.close_file()
-    io = self.open_file()
-    if io is None: return
+      state = logfile.changed()
+      if state == "rotated":
+        # the rotated file is drained before the new one is read.
+        logfile.draining = logfile.detach()
+        target.change_state("rotated", Event.INFO)
+        if not self.open_file(logfile):
+          return
+      elif state is not None:
+        target.change_state(state, Event.INFO)
+        logfile.record = []
+        logfile.rewind()
+        target["__header__"] = logfile.header
+        target["__seek__"] = 0
+        self.update_seek(logfile, 0)
+        target.change_state("opened", Event.INFO)
+    if logfile.draining is not None and not self.drain(logfile):
+      return
+    max_backlog = self.attrs["max_backlog"]
+    if max_backlog is not None and logfile.remaining() > max_backlog:
+      logfile.record = []
+      skipped = logfile.skip_to_end()
+      logfile.skipped += skipped
+      target["__skipped__"] = skipped
+      self.update_seek(logfile, logfile.position)
+      target.change_state("skipped", Event.WARN, check_state=False)
+    self.read_lines(logfile)
+    logfile.backlog = target["__backlog__"] = logfile.remaining()
+
+  def read_lines(self, logfile, final=False, checkpoint=True):
+    # reads within the budget, returns False when it stopped before the end.
+    lines = 0
+    checkpointed_at = time.time()
+    records = self.record_start is not None or self.continuation is not None
+    if self.over_budget():
+      self.behind = True
+      return False
+    stopped = False
+    # bytes and time are charged by the scanned range, so that lines the
+    # prefilter skips count as well.
+    max_bytes = self.attrs["max_tick_bytes"] - self.tick_bytes
+    deadline = self.tick_started_at + self.attrs["max_tick_time"]
+    position = logfile.position
+    for data in logfile.lines(self.prefilter, final, max_bytes, deadline):
+      line = logfile.decode(data)
+      if records:
+        self.add_record_line(logfile, line, logfile.position - len(data))
+      else:
+        self.match(logfile, line)
+      lines += 1
+      self.tick_lines += 1
+      if self.tick_lines >= self.attrs["max_tick_lines"]:
+        stopped = True
+        break
+      if not checkpoint:
+        continue
+      if lines >= self.attrs["checkpoint_lines"] or time.time() - checkpointed_at >= self.attrs["checkpoint_interval"]:
+        self.update_seek(logfile, self.checkpoint_position(logfile))
+        KERNEL.db_thread.flush()
+        lines = 0
+        checkpointed_at = time.time()
+    self.tick_bytes += logfile.position - position
+    stopped = stopped or logfile.limited
+    self.behind = self.behind or stopped
+    # the last record is complete when no lines follow it for a while.
+    if logfile.record and not stopped and (final or time.time() - logfile.record_at >= self.attrs["record_timeout"]):
+      self.match(logfile, u_("").join(logfile.record))
+      logfile.record = []
+    if checkpoint:
+      self.update_seek(logfile, self.checkpoint_position(logfile))
+    return not stopped
+
+  def checkpoint_position(self, logfile):
+    # an incomplete record is read again after a restart.
+    return logfile.record_position if logfile.record else logfile.position
+
+  def add_record_line(self, logfile, line, position):
+    if logfile.record:
+      if self.record_start is not None:
+        continued = not self.record_start.match(line)
+      else:
+        continued = self.continuation.match(line) is not None
+      if continued:
+        if len(logfile.record) < self.attrs["max_record_lines"]:
+          logfile.record.append(line)
+        logfile.record_at = time.time()
+        return
+      self.match(logfile, u_("").join(logfile.record))
+    logfile.record = [line]
+    logfile.record_position = position
+    logfile.record_at = time.time()
+
+  def match(self, logfile, line):
+    for i, m in self.pattern_set.matches(line):
+      target = self.attrs["targets"][i]
+      if target["aggregate"]:
+        self.aggregate(target, logfile, line.strip())
+        continue
+      target["__file__"] = logfile.path
+      target["__line__"] = line.strip()
+      target["__matchobj__"] = m
+      level = target.get("level", Event.ERROR)
+      target.change_state(Event.as_string(level).lower(), level, check_state=False)
+
+  def aggregate(self, target, logfile, line):
+    aggregation = target["__aggregation__"]
+    if aggregation is None:
+      aggregation = target["__aggregation__"] = {
+        "started_at": time.time(), "file": logfile.path, "count": 0,
+        "first_line": line, "samples": []}
+    aggregation["count"] += 1
+    aggregation["last_line"] = line
+    # keeps a uniform sample of the lines(reservoir sampling).
+    samples = aggregation["samples"]
+    if len(samples) < target.get("samples", 5):
+      samples.append(line)
+    else:
+      i = random.randrange(aggregation["count"])
+      if i < len(samples):
+        samples[i] = line
 
-    while True:
-      where = io.tell()
-      line = io.readline()
+  def flush_aggregations(self, force=False):
+    now = time.time()
+    for target in self.attrs["targets"]:
+      aggregation = target["__aggregation__"]
+      if aggregation is None or not (force or now - aggregation["started_at"] >= target["aggregate"]):
+        continue
+      target["__aggregation__"] = None
+      target["__file__"] = aggregation["file"]
+      target["__line__"] = aggregation["last_line"]
+      target["__count__"] = aggregation["count"]
+      target["__first_line__"] = aggregation["first_line"]
+      target["__last_line__"] = aggregation["last_line"]
+      target["__samples__"] = aggregation["samples"]
+      level = target.get("level", Event.ERROR)
+      target.change_state("aggregated", level, check_state=False)
 
-      if not line:
-        io.seek(where)
-        break
+# }}}
+
+class GlobLogMonitor(LogMonitor): # {{{
+  def __init__(self, attrs):
+    self.start_tick()
+    self.notify_lock = threading.Lock()
+    self.notify_timer = None
+    Monitor.__init__(self, attrs)
+
+  def default_attrs(self):
+    attrs = LogMonitor.default_attrs(self)
+    attrs["max_open_files"] = 64
+    return attrs
+
+  def init_attrs(self):
+    Monitor.init_attrs(self)
+    self.init_patterns()
+    self.logfiles = {}
+    # opened files in least recently read order.
+    self.opened = collections.OrderedDict()
+    self.directories = set()
+    self.scanned = False
+    self.archive = None
+    self.resume_path = None
+
+  def close_file(self):
+    for logfile in iter_values(self.logfiles):
+      self.close_logfile(logfile)
+    self.opened.clear()
+    if self.archive is not None:
+      self.archive.close()
+
+  def stop(self):
+    Monitor.stop(self)
+    if self.attrs["inotify"]:
+      for directory in self.directories:
+        KERNEL.watcher.unwatch_path((self, directory))
+      self.cancel_notify()
+    self.close_file()
+    self.flush_aggregations(force=True)
+
+  def watch(self, logfile):
+    pass
+
+  def discover(self):
+    found = set()
+    for pattern in self.attrs["files"]:
+      found.update(v for v in glob.glob(pattern) if os.path.isfile(v))
+    if self.attrs["inotify"]:
+      # watching directories finds new files and writes to all of them.
+      directories = set(os.path.dirname(v) for v in found)
+      directories.update(v for v in (os.path.dirname(v) for v in self.attrs["files"]) if os.path.isdir(v))
+      for directory in directories - self.directories:
+        KERNEL.watcher.watch_path((self, directory), directory, self.notify)
+      self.directories.update(directories)
+
+    for path in found:
+      if path not in self.logfiles:
+        logfile = LogFile(path, self.attrs.get("encoding", "utf8"))
+        logfile.target = Target(self, dict(self.attrs, file=path))
+        self.logfiles[path] = logfile
+    for path in list(self.logfiles):
+      if path not in found:
+        # reads the rest of a removed file within the budget.
+        logfile = self.logfiles[path]
+        if logfile.draining is not None and not self.drain(logfile):
+          continue
+        if logfile.io is not None:
+          if not self.read_lines(logfile, final=True):
+            continue
+          logfile.close()
+          self.opened.pop(path, None)
+        del self.logfiles[path]
+
+  def open_file(self, logfile):
+    while len(self.opened) >= self.attrs["max_open_files"]:
+      path, oldest = self.opened.popitem(last=False)
+      oldest.close()
+    return LogMonitor.open_file(self, logfile)
+
+  def tail(self, logfile):
+    if logfile.io is None and logfile.stat is not None and logfile.draining is None:
+      # skips files closed by max_open_files that have not been changed.
+      try:
+        stat = os.stat(logfile.path)
+      except OSError:
+        return
+      if (stat.st_ino, stat.st_dev) == (logfile.stat.st_ino, logfile.stat.st_dev):
+        if logfile.at_end if logfile.compressed else stat.st_size == logfile.position:
+          return
+    LogMonitor.tail(self, logfile)
+    self.opened.pop(logfile.path, None)
+    if logfile.io is not None:
+      self.opened[logfile.path] = logfile
 
-      for target in self.attrs["targets"]:
-        if line:
-          m = target["__pattern__"].match(line)
-          if m:
-            target["__line__"] = line.strip()
-            target["__matchobj__"] = m
-            level = target.get("level", Event.ERROR)
-            target.change_state(Event.as_string(level).lower(), level, check_state=False)
-      self.update_seek(io.tell())
+  def tailed(self):
+    return list(iter_values(self.logfiles))
 
+  def monitor(self):
+    self.start_tick()
+    self.scan_archives()
+    self.discover()
+    # files after the one that used up the last budget are read first.
+    paths = sorted(self.logfiles)
+    if self.resume_path is not None:
+      paths = [v for v in paths if v > self.resume_path] + [v for v in paths if v <= self.resume_path]
+    self.resume_path = None
+    for path in paths:
+      self.tail(self.logfiles[path])
+      if self.behind:
+        self.resume_path = path
+        break
+    self.flush_aggregations()
+    KERNEL.db_thread.flush()
+    if self.behind:
+      self.wakeup()
 # }}}
 
 class Kernel(object): # {{{
   def __init__(self, attrs):
     self.attrs = attrs
+    self.scheduler = None
 
   def signal_handler(self, sig, frame):
     self.shutdown()
@@ -462,35 +2901,69 @@ class Kernel(object): # {{{
 
   def shutdown(self):
     LOGGER.info("==== Receive SIGINT signal......... ====")
+    self.stop_dispatcher()
     for monitor in self.monitors:
       LOGGER.info("Stopping a monitor: {}".format(monitor.__class__.__name__))
       monitor.stop()
     LOGGER.info("Stopping an event thread.")
     self.event_thread.stop()
+    LOGGER.info("Stopping a watcher thread.")
+    self.watcher.stop()
+    self.store.flush(force=True)
     LOGGER.info("Stopping a db thread.")
     self.db_thread.stop()
     LOGGER.info("==== Shutting down thistle: success ====")
 
+  def start_dispatcher(self):
+    if self.attrs.get("mode", "thread") == "scheduler":
+      self.scheduler = Scheduler(self.attrs.get("workers", 4))
+      LOGGER.info("Starting up a scheduler.")
+      self.scheduler.start()
+
+  def stop_dispatcher(self):
+    if self.scheduler is not None:
+      LOGGER.info("Stopping a scheduler.")
+      self.scheduler.stop()
+
+  def start_monitor(self, monitor):
+    if self.scheduler is not None:
+      self.scheduler.schedule(monitor, time.time() + self.attrs["waiting_time_on_boot"])
+    else:
+      monitor.start()
+
+  def wakeup(self, monitor):
+    if self.scheduler is not None:
+      self.scheduler.wakeup(monitor)
+    elif not monitor.wakeup_pending:
+      monitor.wakeup_pending = True
+      monitor.queue.put(WAKEUP_THREAD)
+
   def start(self, loop=True):
     LOGGER.info("==== Starting up thistle......... ====")
     try:
       with open(self.attrs["pid_file"], "w") as io:
         io.write(u_(os.getpid()))
       signal.signal(signal.SIGINT, self.signal_handler)
+      COMMAND_RUNNER.configure(**self.attrs.get("command_runner", {}))
 
       self.db_thread = DBThread()
       LOGGER.info("Starting up a db thread.")
       self.db_thread.start()
+      self.store = TimeSeriesStore(self.db_thread, **self.attrs.get("store", {}))
       self.event_thread = EventThread()
       LOGGER.info("Starting up an event thread.")
       self.event_thread.start()
+      self.watcher = Watcher(self.attrs.get("watch_interval", 1))
+      LOGGER.info("Starting up a watcher thread.")
+      self.watcher.start()
+      self.start_dispatcher()
 
       self.monitors = []
       for monitor_spec in self.attrs["monitors"]:
         monitor = monitor_spec[0](monitor_spec[1])
         self.monitors.append(monitor)
         LOGGER.info("Starting up monitor: {}".format(monitor.__class__.__name__))
-        monitor.start()
+        self.start_monitor(monitor)
     except Exception as e:
       LOGGER.info("==== Starting up thistle: failed ====")
       LOGGER.error(e)
@@ -510,6 +2983,88 @@ class Kernel(object): # {{{
     os.remove(self.attrs["pid_file"])
 # }}}
 
+class AsyncKernel(Kernel): # {{{
+  def __init__(self, attrs):
+    Kernel.__init__(self, attrs)
+    self.loop = None
+    self.handles = {}
+    self.running = 0
+    self.active = set()
+    self.pending = set()
+    self.stopping = False
+
+  def start_dispatcher(self):
+    if asyncio is None:
+      raise RuntimeError("AsyncKernel requires Python 3.4 or later.")
+    import concurrent.futures
+    self.loop = asyncio.new_event_loop()
+    self.executor = concurrent.futures.ThreadPoolExecutor(self.attrs.get("workers", 4))
+    self.loop_thread = threading.Thread(target=self.loop.run_forever)
+    LOGGER.info("Starting up an event loop.")
+    self.loop_thread.start()
+
+  def stop_dispatcher(self):
+    LOGGER.info("Stopping an event loop.")
+    self.loop.call_soon_threadsafe(self.stop_loop)
+    self.loop_thread.join()
+    self.executor.shutdown(wait=True)
+    self.loop.close()
+
+  def stop_loop(self):
+    self.stopping = True
+    for handle in iter_values(self.handles):
+      handle.cancel()
+    self.handles.clear()
+    if self.running == 0:
+      self.loop.stop()
+
+  def start_monitor(self, monitor):
+    self.loop.call_soon_threadsafe(self.schedule, monitor, self.attrs["waiting_time_on_boot"])
+
+  def schedule(self, monitor, delay):
+    if not self.stopping:
+      self.handles[monitor] = self.loop.call_later(delay, self.dispatch, monitor)
+
+  def wakeup(self, monitor):
+    self.loop.call_soon_threadsafe(self.wakeup_monitor, monitor)
+
+  def wakeup_monitor(self, monitor):
+    handle = self.handles.pop(monitor, None)
+    if handle is not None:
+      handle.cancel()
+      self.dispatch(monitor)
+    elif monitor in self.active:
+      self.pending.add(monitor)
+
+  def dispatch(self, monitor):
+    self.handles.pop(monitor, None)
+    self.active.add(monitor)
+    started_at = self.loop.time()
+    def done(future):
+      self.running -= 1
+      self.active.discard(monitor)
+      if not future.cancelled() and future.exception() is not None:
+        LOGGER.error("Error in {}: {}".format(monitor.__class__.__name__, u_(future.exception())))
+      if self.stopping:
+        if self.running == 0:
+          self.loop.stop()
+        return
+      t = self.loop.time() - started_at
+      if monitor in self.pending:
+        self.pending.discard(monitor)
+        t = monitor.attrs["interval"]
+      now = time.time()
+      self.schedule(monitor, max(monitor.next_tick(now - t) - now, 0))
+
+    self.running += 1
+    try:
+      future = monitor.async_monitor(self.loop, self.executor)
+    except Exception as e:
+      future = self.loop.create_future()
+      future.set_exception(e)
+    future.add_done_callback(done)
+# }}}
+
 if __name__ == "__main__": # {{{
   import argparse
 
@@ -523,7 +3078,7 @@ if __name__ == "__main__": # {{{
   import plugins
   sys.modules["thistle.plugins"] = plugins
   try:
-    config = __import__(re.sub("\.py$", "", os.path.basename(args.config)))
+    config = __import__(re.sub(r"\.py$", "", os.path.basename(args.config)))
     if args.command == "test":
       print("OK")
   except:
@@ -535,7 +3090,7 @@ if __name__ == "__main__": # {{{
     else:
       raise
   if args.command != "test":
-    KERNEL = Kernel(config.config)
+    KERNEL = config.config.get("kernel", Kernel)(config.config)
     getattr(KERNEL, args.command)()
 #  }}}
 
@@ -65,7 +65,7 @@ config = {
     (CommandOutputVarMonitor, {
       "interval": 300,
       "logger": command_logger("/var/log/thistle/sysinfo.log"),
-      "command" : [os.path.join(PATH, "plugins", "sysinfo.sh")],
+      "command" : SysInfo(),
       "targets": [
         {"name" : "CPU_USAGE",
          "gt" : 95 },
@@ -85,7 +85,9 @@ config = {
       "encoding": "utf8",
       "targets": [
         {"pattern": ".*error.*",
-         "message": "error has occurred."},
+         "message": "error has occurred.",
+         "rate_limit": 1/60.0,
+         "burst": 5},
         {"pattern": ".*warn.*",
          "message": "warn has occurred.",
          "level": Event.WARN}